@@ -16,11 +16,22 @@ login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
 
-from app.models import User
+from app.models import User, SessionUser
+from app.cache import TTLCache
+from app.metrics import register
+
+# Logged in users by id, so most requests don't query the users table.
+# Settings changes invalidate this process's entry, other workers catch up within the TTL
+user_cache = register('user_cache', TTLCache(app.config['USER_CACHE_TTL'], max_entries=app.config['USER_CACHE_SIZE']))
+
+def _load_session_user(user_id):
+    row = db.session.execute(db.select(User.id, User.username).where(User.id == user_id)).first()
+    return SessionUser(row.id, row.username) if row else None
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    return user_cache.get(user_id, lambda: _load_session_user(user_id))
 
 
-from app import views, models
\ No newline at end of file
+from app import views, models, commands
\ No newline at end of file
@@ -0,0 +1,395 @@
+"""
+Predicts review ratings by matrix factorization.
+
+Every user and movie gets a vector of a few dozen numbers, fitted so that a
+user's 1-10 rating of a movie is close to the mean rating plus the dot
+product of the two vectors. Alternating least squares fits them: with the
+movie vectors fixed, each user's vector is a small ridge regression over the
+movies they rated, and the other way round.
+
+Each half step is split into blocks of rows, solved by a pool of processes.
+The ratings and factors are memory mapped files in a scratch directory, so
+workers read the fixed side and write their rows of the other side in place
+rather than pickling them back and forth.
+"""
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select, func
+
+from app import app, db
+from app.artifacts import Artifact, ArtifactFile, write_artifact
+from app.metrics import Counter, register
+from app.models import Review
+from app.sync import get_state, set_state
+
+WATERMARK_KEY = 'als_reviews'
+# Ratings solved per task, padded to at most twice as many factor vectors
+# while solving, 16 MB per worker at 32 factors
+BLOCK_RATINGS = 65536
+# Sweeps over the users and movies of new reviews in a warm start
+WARM_ITERATIONS = 3
+# Ids per IN (...) query, well under SQLite's bound parameter limit
+CHUNK_SIZE = 500
+MIN_RATING, MAX_RATING = 1, 10
+
+
+class RatingModel:
+    """
+    Fitted factors. users and movies are sorted ids, row i of user_factors
+    and item_factors belongs to users[i] and movies[i].
+    """
+
+    def __init__(self, users, movies, user_factors, item_factors, mean):
+        self.users = users
+        self.movies = movies
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+        self.mean = float(mean)
+
+    def rows(self, ids, side='movies'):
+        """
+        Row of each id in the user or movie factors, -1 where it has none.
+        """
+        known = getattr(self, side)
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(known):
+            return np.full(len(ids), -1)
+        rows = np.minimum(np.searchsorted(known, ids), len(known) - 1)
+        return np.where(known[rows] == ids, rows, -1)
+
+    def predict_rows(self, user_rows, movie_rows):
+        """
+        Predicted ratings for parallel arrays of factor rows, clipped to 1-10.
+        """
+        dots = np.einsum('ij,ij->i', self.user_factors[user_rows], self.item_factors[movie_rows])
+        return np.clip(self.mean + dots, MIN_RATING, MAX_RATING)
+
+    def predict(self, user_id, movie_ids):
+        """
+        {movie_id: predicted rating} for the movies the model knows,
+        empty if it doesn't know the user.
+        """
+        user_row = self.rows([user_id], 'users')[0]
+        movie_rows = self.rows(movie_ids)
+        known = movie_rows >= 0
+        if user_row < 0 or not known.any():
+            return {}
+        predictions = self.predict_rows(np.full(int(known.sum()), user_row), movie_rows[known])
+        return dict(zip(np.asarray(movie_ids, dtype=np.int64)[known].tolist(), predictions.tolist()))
+
+
+def rmse(model, user_ids, movie_ids, ratings):
+    """
+    Root mean squared error of the model on (user_id, movie_id, rating) arrays.
+    Pairs with a user or movie the model doesn't know are predicted as the mean.
+    """
+    user_rows = model.rows(user_ids, 'users')
+    movie_rows = model.rows(movie_ids)
+    predictions = np.full(len(ratings), model.mean)
+    known = (user_rows >= 0) & (movie_rows >= 0)
+    predictions[known] = model.predict_rows(user_rows[known], movie_rows[known])
+    return float(np.sqrt(np.mean((predictions - ratings) ** 2))) if len(ratings) else 0.0
+
+
+def solve_rows(indptr, indices, data, fixed, mean, regularization):
+    """
+    Least squares factors for the rows of a CSR slice of ratings, given the
+    factors of the other side. Each row's regularization grows with its number
+    of ratings (ALS-WR). Rows without ratings get zeros.
+    """
+    counts = np.diff(indptr)
+    n_factors = fixed.shape[1]
+    solved = np.zeros((len(counts), n_factors), dtype=np.float32)
+    identity = np.eye(n_factors, dtype=np.float32)
+
+    # Rows with similar numbers of ratings are padded to the same length, so
+    # every row's sums come out of one batched matrix product per group
+    groups = np.ceil(np.log2(np.maximum(counts, 1))).astype(np.int64)
+    for group in np.unique(groups[counts > 0]):
+        rows = np.nonzero((groups == group) & (counts > 0))[0]
+        width = 1 << int(group)
+        offsets = np.arange(width)
+        present = offsets < counts[rows, None]
+        positions = np.where(present, indptr[rows, None] + offsets, indptr[rows, None])
+
+        vectors = fixed[indices[positions]] * present[:, :, None]
+        residuals = (data[positions] - mean) * present
+        transposed = vectors.transpose(0, 2, 1)
+        grams = transposed @ vectors + (regularization * counts[rows])[:, None, None] * identity
+        targets = transposed @ residuals[:, :, None]
+        solved[rows] = np.linalg.solve(grams, targets)[:, :, 0]
+    return solved
+
+
+def _blocks(indptr, block_ratings=BLOCK_RATINGS):
+    """
+    (start, end) row ranges holding about block_ratings ratings each.
+    """
+    n_rows = len(indptr) - 1
+    cuts = np.searchsorted(indptr, np.arange(block_ratings, indptr[-1], block_ratings))
+    edges = np.unique(np.concatenate([[0], cuts, [n_rows]]))
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+
+# Memory mapped arrays of the training run, opened once in each pool worker
+_arrays = {}
+
+
+def _open_arrays(directory):
+    _arrays.clear()
+    for name in os.listdir(directory):
+        _arrays[name[:-4]] = np.load(os.path.join(directory, name), mmap_mode='r+')
+
+
+def _solve_block(side, start, end, mean, regularization):
+    """
+    Solves rows start:end of side ('users' or 'items') in place. Returns
+    the number of ratings used.
+    """
+    other = 'items' if side == 'users' else 'users'
+    indptr = _arrays[side + '_indptr'][start:end + 1]
+    _arrays[side][start:end] = solve_rows(
+        indptr, _arrays[side + '_indices'], _arrays[side + '_ratings'], _arrays[other], mean, regularization
+    )
+    return int(indptr[-1] - indptr[0])
+
+
+def train_als(user_ids, movie_ids, ratings, factors=32, regularization=0.1, iterations=10,
+              workers=None, seed=0, log=None):
+    """
+    Fits a RatingModel to parallel arrays of (user_id, movie_id, rating),
+    one rating per pair, with a pool of workers processes (one per CPU by default).
+    """
+    users, user_index = np.unique(np.asarray(user_ids, dtype=np.int64), return_inverse=True)
+    movies, movie_index = np.unique(np.asarray(movie_ids, dtype=np.int64), return_inverse=True)
+    ratings = np.asarray(ratings, dtype=np.float32)
+    mean = float(ratings.mean()) if len(ratings) else 0.0
+    by_user = sparse.csr_matrix((ratings, (user_index, movie_index)), shape=(len(users), len(movies)))
+    by_item = by_user.T.tocsr()
+
+    rng = np.random.default_rng(seed)
+    arrays = {
+        'users': np.zeros((len(users), factors), dtype=np.float32),
+        'items': (rng.standard_normal((len(movies), factors)) * 0.1).astype(np.float32),
+    }
+    for side, matrix in (('users', by_user), ('items', by_item)):
+        arrays[side + '_indptr'] = matrix.indptr.astype(np.int64)
+        arrays[side + '_indices'] = matrix.indices
+        arrays[side + '_ratings'] = matrix.data
+    blocks = {side: _blocks(arrays[side + '_indptr']) for side in ('users', 'items')}
+
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory(prefix='als-') as directory:
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + '.npy'), array)
+        _open_arrays(directory)
+        pool = multiprocessing.Pool(workers, _open_arrays, (directory,)) if workers > 1 else None
+        try:
+            for iteration in range(1, iterations + 1):
+                started = time.monotonic()
+                for side in ('users', 'items'):
+                    tasks = [(side, start, end, mean, regularization) for start, end in blocks[side]]
+                    if pool is None:
+                        for task in tasks:
+                            _solve_block(*task)
+                    else:
+                        pool.starmap(_solve_block, tasks)
+                if log:
+                    elapsed = time.monotonic() - started
+                    model = RatingModel(users, movies, _arrays['users'], _arrays['items'], mean)
+                    log(f'Iteration {iteration}: {len(ratings) / elapsed:,.0f} ratings/s, '
+                        f'training RMSE {rmse(model, user_ids, movie_ids, ratings):.3f}')
+            return RatingModel(users, movies, np.array(_arrays['users']), np.array(_arrays['items']), mean)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _arrays.clear()
+
+
+def fold_in(model, user_ids, movie_ids, ratings, new_users, new_movies, regularization=0.1,
+            iterations=WARM_ITERATIONS):
+    """
+    Refits only the users and movies in new_users and new_movies, keeping
+    every other factor as it is. The ratings must include all of their
+    ratings, those of other users and movies are not needed.
+    """
+    users = np.union1d(model.users, new_users)
+    movies = np.union1d(model.movies, new_movies)
+    factors = model.user_factors.shape[1]
+    user_factors = np.zeros((len(users), factors), dtype=np.float32)
+    item_factors = np.zeros((len(movies), factors), dtype=np.float32)
+    user_factors[np.searchsorted(users, model.users)] = model.user_factors
+    item_factors[np.searchsorted(movies, model.movies)] = model.item_factors
+
+    by_user = sparse.csr_matrix(
+        (np.asarray(ratings, dtype=np.float32), (np.searchsorted(users, user_ids), np.searchsorted(movies, movie_ids))),
+        shape=(len(users), len(movies)),
+    )
+    user_rows = np.searchsorted(users, new_users)
+    item_rows = np.searchsorted(movies, new_movies)
+    sides = ((by_user[user_rows], user_rows, user_factors, item_factors),
+             (by_user.T.tocsr()[item_rows], item_rows, item_factors, user_factors))
+
+    # Few rows change, so this runs in process, still in blocks to bound memory
+    for _ in range(iterations):
+        for matrix, rows, solving, fixed in sides:
+            for start, end in _blocks(matrix.indptr):
+                solving[rows[start:end]] = solve_rows(
+                    matrix.indptr[start:end + 1], matrix.indices, matrix.data, fixed, model.mean, regularization
+                )
+    return RatingModel(users, movies, user_factors, item_factors, model.mean)
+
+
+def latest_ratings(review_ids, user_ids, movie_ids, ratings):
+    """
+    Drops all but the newest review of each user and movie, as arrays
+    of (user_id, movie_id, rating).
+    """
+    order = np.lexsort((-review_ids, movie_ids, user_ids))
+    user_ids, movie_ids, ratings = user_ids[order], movie_ids[order], ratings[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (user_ids[1:] != user_ids[:-1]) | (movie_ids[1:] != movie_ids[:-1])
+    return user_ids[first], movie_ids[first], ratings[first]
+
+
+def load_reviews(up_to_id, user_ids=None, movie_ids=None):
+    """
+    (review id, user_id, movie_id, rating) arrays of every review up to
+    up_to_id, or only those by user_ids or of movie_ids when given.
+    """
+    query = select(Review.id, Review.user_id, Review.movie_id, Review.rating).where(Review.id <= up_to_id)
+    if user_ids is None and movie_ids is None:
+        queries = [query]
+    else:
+        queries = [query.where(Review.user_id.in_(chunk)) for chunk in _chunks(user_ids)]
+        queries += [query.where(Review.movie_id.in_(chunk)) for chunk in _chunks(movie_ids)]
+
+    rows = {}
+    for statement in queries:
+        rows.update((row[0], row) for row in db.session.execute(statement))
+    table = np.array(list(rows.values()), dtype=np.int64).reshape(-1, 4)
+    return table[:, 0], table[:, 1], table[:, 2], table[:, 3]
+
+
+def _chunks(ids):
+    ids = np.asarray(ids).tolist()
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def save_model(path, model):
+    """
+    Writes the model as an artifact, swapped in atomically.
+    """
+    write_artifact(path, 'ratings', {
+        'users': model.users.astype(np.int64),
+        'movies': model.movies.astype(np.int64),
+        'user_factors': model.user_factors.astype(np.float32),
+        'item_factors': model.item_factors.astype(np.float32),
+        'mean': np.array([model.mean], dtype=np.float32),
+    })
+
+
+def model_from(artifact):
+    return RatingModel(artifact['users'], artifact['movies'], artifact['user_factors'],
+                       artifact['item_factors'], artifact['mean'][0])
+
+
+def load_model(path):
+    return model_from(Artifact(path, 'ratings'))
+
+
+class RatingPredictor:
+    """
+    Serves predictions from the model train-als writes, mapped from the
+    file and remapped when it's replaced.
+    """
+
+    def __init__(self, path):
+        self.file = ArtifactFile(path, 'ratings')
+        self.stats = Counter('requests', 'unknown')
+        self._loaded = (None, None)
+
+    def _current(self):
+        artifact = self.file.current()
+        if artifact is None:
+            return None
+        # The model only wraps the mapped arrays, it's rebuilt along with them
+        loaded_from, model = self._loaded
+        if artifact is not loaded_from:
+            model = model_from(artifact)
+            self._loaded = (artifact, model)
+        return model
+
+    def predict(self, user_id, movie_ids):
+        """
+        {movie_id: predicted 1-10 rating} for the movies there is a prediction for.
+        """
+        self.stats.inc('requests')
+        model = self._current()
+        predictions = model.predict(user_id, movie_ids) if model is not None else {}
+        if not predictions:
+            self.stats.inc('unknown')
+        return predictions
+
+    def snapshot(self):
+        stats = self.stats.snapshot()
+        artifact = self.file.current()
+        stats['loads'] = self.file.loads
+        stats['users'] = len(artifact['users']) if artifact is not None else 0
+        stats['movies'] = len(artifact['movies']) if artifact is not None else 0
+        stats['trained_at'] = artifact.version / 1e9 if artifact is not None else None
+        return stats
+
+
+rating_predictor = register('ratings', RatingPredictor(app.config['ALS_PATH']))
+
+
+def train_ratings(warm=False, factors=None, iterations=None, workers=None, log=print):
+    """
+    Trains the rating model on every review, or with warm only refits the
+    users and movies reviewed since the last run. Saves it and moves the
+    watermark, the caller commits. Returns the number of reviews used.
+    """
+    path = app.config['ALS_PATH']
+    regularization = app.config['ALS_REGULARIZATION']
+    watermark = int(get_state(WATERMARK_KEY, 0))
+    # Reviews after this are left for the next run
+    up_to_id = db.session.scalar(select(func.max(Review.id))) or 0
+
+    if warm and os.path.exists(path):
+        new = db.session.execute(
+            select(Review.user_id, Review.movie_id).where(Review.id > watermark, Review.id <= up_to_id)
+        ).all()
+        if not new:
+            log('No new reviews')
+            return 0
+        new_users = np.unique([row.user_id for row in new])
+        new_movies = np.unique([row.movie_id for row in new])
+        started = time.monotonic()
+        user_ids, movie_ids, ratings = latest_ratings(*load_reviews(up_to_id, new_users, new_movies))
+        model = fold_in(load_model(path), user_ids, movie_ids, ratings, new_users, new_movies,
+                        regularization=regularization)
+        log(f'{len(new):,} new reviews folded in for {len(new_users):,} users and '
+            f'{len(new_movies):,} movies in {time.monotonic() - started:.2f}s')
+        used = len(new)
+    else:
+        started = time.monotonic()
+        user_ids, movie_ids, ratings = latest_ratings(*load_reviews(up_to_id))
+        log(f'{len(ratings):,} ratings read in {time.monotonic() - started:.1f}s')
+        model = train_als(user_ids, movie_ids, ratings,
+                          factors=factors or app.config['ALS_FACTORS'],
+                          regularization=regularization,
+                          iterations=iterations or app.config['ALS_ITERATIONS'],
+                          workers=workers, log=log)
+        used = len(ratings)
+
+    save_model(path, model)
+    set_state(WATERMARK_KEY, str(up_to_id))
+    return used
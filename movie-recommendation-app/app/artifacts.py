@@ -0,0 +1,138 @@
+"""
+Model files every worker maps into memory instead of loading.
+
+An artifact is a fixed layout binary file: a header, a table with the name,
+dtype, shape and offset of each array, then the arrays themselves, each
+starting on a 64 byte boundary. Workers mmap it read-only and use numpy
+views straight onto the mapping, so however many workers there are, the
+operating system keeps one copy of it in the page cache.
+
+A new version is written to a temporary file and renamed over the old one.
+Workers notice the new inode or mtime and map the new file. Arrays still
+held from the old mapping stay valid, the old file is freed once the last
+of them is dropped.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b'MOVIEART'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+MAX_DIMENSIONS = 4
+
+# magic, format version, kind, model version, number of arrays
+HEADER = struct.Struct('<8sI16sQI')
+# name, dtype, number of dimensions, shape, offset, size in bytes
+ENTRY = struct.Struct('<32s8sI%dQQQ' % MAX_DIMENSIONS)
+
+
+class ArtifactError(Exception):
+    pass
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_artifact(path, kind, arrays):
+    """
+    Writes a dict of numeric arrays to path as an artifact of the given kind,
+    swapping it in atomically. Returns its version, the time it was written in ns.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    version = time.time_ns()
+
+    # Lay the arrays out after the header and the table
+    offset = _aligned(HEADER.size + ENTRY.size * len(arrays))
+    entries = []
+    for name, array in arrays.items():
+        if array.ndim > MAX_DIMENSIONS or array.dtype.kind not in 'iuf':
+            raise ArtifactError(f'{name}: only numeric arrays of up to {MAX_DIMENSIONS} dimensions are stored')
+        shape = array.shape + (0,) * (MAX_DIMENSIONS - array.ndim)
+        entries.append(ENTRY.pack(name.encode(), array.dtype.str.encode(), array.ndim, *shape, offset, array.nbytes))
+        offset = _aligned(offset + array.nbytes)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as tmp_file:
+        tmp_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, kind.encode(), version, len(arrays)))
+        tmp_file.write(b''.join(entries))
+        for array in arrays.values():
+            if array.nbytes:
+                tmp_file.seek(_aligned(tmp_file.tell()))
+                tmp_file.write(memoryview(array).cast('B'))
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+    return version
+
+
+class Artifact:
+    """
+    A mapped artifact. arrays holds read-only views into the mapping.
+    """
+
+    def __init__(self, path, kind):
+        with open(path, 'rb') as artifact_file:
+            stat = os.fstat(artifact_file.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns)
+            self._map = mmap.mmap(artifact_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, format_version, found_kind, self.version, count = HEADER.unpack_from(self._map, 0)
+        found_kind = found_kind.rstrip(b'\0').decode()
+        if magic != MAGIC:
+            raise ArtifactError(f'{path} is not a model artifact')
+        if format_version != FORMAT_VERSION:
+            raise ArtifactError(f'{path} has format {format_version}, this code reads {FORMAT_VERSION}')
+        if found_kind != kind:
+            raise ArtifactError(f'{path} holds {found_kind}, not {kind}')
+
+        self.arrays = {}
+        for position in range(count):
+            name, dtype, ndim, *rest = ENTRY.unpack_from(self._map, HEADER.size + position * ENTRY.size)
+            shape, (offset, nbytes) = rest[:ndim], rest[MAX_DIMENSIONS:]
+            dtype = np.dtype(dtype.rstrip(b'\0').decode())
+            if nbytes:
+                array = np.frombuffer(self._map, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset)
+            else:
+                # An empty array may sit past the end of the file
+                array = np.empty(0, dtype=dtype)
+                array.flags.writeable = False
+            self.arrays[name.rstrip(b'\0').decode()] = array.reshape(shape)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+
+class ArtifactFile:
+    """
+    The current version of an artifact for this worker, remapped when the
+    file at path is replaced. current() is None while there is no file.
+    """
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.loads = 0
+        self._lock = threading.Lock()
+        self._artifact = None
+
+    def current(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        identity = (stat.st_ino, stat.st_mtime_ns)
+        artifact = self._artifact
+        if artifact is None or artifact.identity != identity:
+            with self._lock:
+                if self._artifact is None or self._artifact.identity != identity:
+                    self._artifact = Artifact(self.path, self.kind)
+                    self.loads += 1
+                artifact = self._artifact
+        return artifact
@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+from app import app
+from app.metrics import Counter
+
+
+class TTLCache:
+    """
+    In-process LRU cache shared by every thread of a worker.
+    Entries younger than ttl are fresh. Entries older than ttl but younger than
+    ttl + stale_ttl are served as they are while one background thread reloads them.
+    """
+
+    def __init__(self, ttl, stale_ttl=0, max_entries=1000):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.stats = Counter('hits', 'misses', 'stale', 'refreshes', 'refresh_errors')
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._refreshing = set()
+
+    def get(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() to fill or refresh it.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                age = now - stored_at
+                if age < self.ttl:
+                    self.stats.inc('hits')
+                    self._entries.move_to_end(key)
+                    return value
+                if age < self.ttl + self.stale_ttl:
+                    self.stats.inc('stale')
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+                    return value
+
+        # Missing or too old to serve, the caller waits for a fresh copy
+        self.stats.inc('misses')
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def is_fresh(self, key):
+        """
+        Checks whether key is cached and still within its TTL, without loading it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and time.monotonic() - entry[1] < self.ttl
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+
+            # Evict the least recently used entries
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Drops key, so the next get() loads it again.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _refresh(self, key, loader):
+        try:
+            value = loader()
+        except Exception:
+            self.stats.inc('refresh_errors')
+            app.logger.exception('Background refresh failed for %r', key)
+        else:
+            self.stats.inc('refreshes')
+            self.set(key, value)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def snapshot(self):
+        stats = self.stats.snapshot()
+        with self._lock:
+            stats['entries'] = len(self._entries)
+        return stats
@@ -0,0 +1,368 @@
+import threading
+import time
+from datetime import datetime, date
+
+import requests
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import app, db, tmdb
+from app.cache import TTLCache
+from app.content import content_index
+from app.enrich import enricher
+from app.metrics import register
+from app.models import Movie, MovieAddition, Like, Review, Genre, movie_genres, average_rating
+from app.singleflight import SingleFlight
+
+# Default release date for movies TMDb has no (valid) date for
+DEFAULT_RELEASE_DATE = date(1900, 1, 1)
+
+# Fields a movie card renders, the overview is cut to what the card shows
+CARD_SCHEMA = {
+    'id': None, 'title': None, 'poster_path': None, 'overview': 100,
+    'like_count': None, 'review_count': None, 'average_rating': None,
+}
+
+# Popular list pages, keyed by (endpoint, page, language)
+popular_cache = register('popular_cache', TTLCache(
+    app.config['TMDB_CACHE_TTL'],
+    stale_ttl=app.config['TMDB_CACHE_STALE_TTL'],
+))
+
+# Concurrent misses for the same page share a single fetch and ingest
+popular_flight = register('popular_flight', SingleFlight(app.config['TMDB_SINGLEFLIGHT_DIR']))
+
+# Genre id -> name per language. The list barely ever changes
+genre_cache = register('genre_cache', TTLCache(app.config['TMDB_GENRE_CACHE_TTL']))
+
+# When this process last queued a fetch of TMDb's genre list, keyed by language
+_genre_fetches = {}
+# Names fetched in languages other than TMDB_LANGUAGE, which the genres table holds
+_genre_translations = {}
+_genre_fetches_lock = threading.Lock()
+
+
+def _release_date(value):
+    """
+    Parses a TMDb release date, common error when searching is an empty or invalid date.
+    """
+    if value:
+        try:
+            return datetime.strptime(value, "%Y-%m-%d").date()
+        except ValueError:
+            pass
+    return DEFAULT_RELEASE_DATE
+
+
+def movie_row(movie_data):
+    """
+    Maps a TMDb result dict onto the columns of the movies table.
+    """
+    return {
+        'id': movie_data['id'],
+        'title': movie_data.get('title') or movie_data.get('original_title', ''),
+        'release_date': _release_date(movie_data.get('release_date')),
+        'poster_path': movie_data.get('poster_path'),
+        'overview': movie_data.get('overview'),
+    }
+
+
+def genre_ids(movie_data):
+    """
+    Genre ids of a TMDb movie, list results have genre_ids and detail responses genre objects.
+    """
+    if 'genre_ids' in movie_data:
+        return movie_data['genre_ids']
+    return [genre['id'] for genre in movie_data.get('genres', [])]
+
+
+def insert_ignore(target, *index_elements):
+    """
+    Builds an INSERT that skips rows clashing on index_elements, if the database supports it.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return sqlite.insert(target).on_conflict_do_nothing(index_elements=list(index_elements))
+    if dialect == 'postgresql':
+        return postgresql.insert(target).on_conflict_do_nothing(index_elements=list(index_elements))
+    return None
+
+
+def store_movie_genres(genre_ids_by_movie, connection=None, replace=False):
+    """
+    Links movies to their genres in bulk, adding any genre ids not seen before.
+    With replace, the movies' existing links are removed first. The caller commits.
+    """
+    connection = connection or db.session
+    pairs = [
+        {'movie_id': movie_id, 'genre_id': genre_id}
+        for movie_id, ids in genre_ids_by_movie.items()
+        for genre_id in dict.fromkeys(ids)
+    ]
+    if replace and genre_ids_by_movie:
+        connection.execute(delete(movie_genres).where(movie_genres.c.movie_id.in_(list(genre_ids_by_movie))))
+    if not pairs:
+        return
+
+    # Genre names are filled in from TMDb's genre list, only the ids are needed here
+    new_genres = {pair['genre_id'] for pair in pairs}
+    stmt = insert_ignore(Genre, 'id')
+    if stmt is None:
+        new_genres -= set(connection.scalars(select(Genre.id).where(Genre.id.in_(new_genres))))
+        stmt = insert(Genre)
+    if new_genres:
+        connection.execute(stmt, [{'id': genre_id} for genre_id in new_genres])
+
+    stmt = insert_ignore(movie_genres, 'movie_id', 'genre_id')
+    connection.execute(stmt if stmt is not None else insert(movie_genres), pairs)
+
+
+def ingest_movies(results):
+    """
+    Stores every movie from a list of TMDb results that isn't in the database yet,
+    using set-based statements instead of a lookup per movie.
+    Returns the ids of the movies that were inserted. The caller commits.
+    """
+    # Drop duplicate ids, pages can overlap when the popular list shifts
+    movies = {movie_data['id']: movie_data for movie_data in results}
+    rows = [movie_row(movie_data) for movie_data in movies.values()]
+    if not rows:
+        return []
+
+    stmt = insert_ignore(Movie, 'id')
+    if stmt is not None and db.engine.dialect.insert_returning:
+        # Single round trip, the database reports which rows were new
+        new_ids = list(db.session.scalars(stmt.returning(Movie.id), rows))
+    else:
+        # Otherwise find existing ids with one IN query and insert the rest in bulk
+        existing = set(db.session.scalars(select(Movie.id).where(Movie.id.in_(list(movies)))))
+        new_rows = [row for row in rows if row['id'] not in existing]
+        if new_rows:
+            db.session.execute(stmt if stmt is not None else insert(Movie), new_rows)
+        new_ids = [row['id'] for row in new_rows]
+
+    store_movie_genres({movie_id: genre_ids(movies[movie_id]) for movie_id in new_ids})
+    if new_ids:
+        # Other workers add these to their content index from the log
+        db.session.execute(insert(MovieAddition), [{'movie_id': movie_id} for movie_id in new_ids])
+    return new_ids
+
+
+def adjust_aggregates(movie_id, likes=0, reviews=0, ratings=0):
+    """
+    Adds to a movie's like count, review count and rating sum in the database
+    itself, so concurrent requests can't lose an update. The caller commits,
+    in the same transaction as the like or review that changed them.
+    """
+    db.session.execute(
+        update(Movie)
+        .where(Movie.id == movie_id)
+        .values(
+            like_count=Movie.like_count + likes,
+            review_count=Movie.review_count + reviews,
+            rating_sum=Movie.rating_sum + ratings,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def reconcile_aggregates():
+    """
+    Recounts every movie's likes and reviews in one statement.
+    Returns the number of movies whose stored values were off. The caller commits.
+    """
+    like_count = select(func.count(Like.id)).where(Like.movie_id == Movie.id).scalar_subquery()
+    review_count = select(func.count(Review.id)).where(Review.movie_id == Movie.id).scalar_subquery()
+    rating_sum = select(func.coalesce(func.sum(Review.rating), 0)).where(Review.movie_id == Movie.id).scalar_subquery()
+
+    result = db.session.execute(
+        update(Movie)
+        .where((Movie.like_count != like_count) | (Movie.review_count != review_count) | (Movie.rating_sum != rating_sum))
+        .values(like_count=like_count, review_count=review_count, rating_sum=rating_sum)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def with_aggregates(movies):
+    """
+    Copies of TMDb result dicts with the stored like and review figures added,
+    read with one primary key lookup for the whole list.
+    """
+    ids = [movie['id'] for movie in movies]
+    stored = {
+        row.id: row for row in db.session.execute(
+            select(Movie.id, Movie.like_count, Movie.review_count, Movie.rating_sum).where(Movie.id.in_(ids))
+        )
+    }
+
+    movies_with_aggregates = []
+    for movie in movies:
+        row = stored.get(movie['id'])
+        like_count, review_count, rating_sum = (row.like_count, row.review_count, row.rating_sum) if row else (0, 0, 0)
+        movies_with_aggregates.append({
+            **movie,
+            'like_count': like_count,
+            'review_count': review_count,
+            'average_rating': average_rating(rating_sum, review_count),
+        })
+    return movies_with_aggregates
+
+
+def _load_popular_page(page, language):
+    """
+    Fetches a popular page and stores its movies. Runs in its own app context
+    so it works the same from a request or from a background refresh thread.
+    """
+    movies = tmdb.popular_movies(page, language)
+    with app.app_context():
+        new_ids = ingest_movies(movies)
+        db.session.commit()
+        content_index.add(new_ids)
+    enricher.submit(new_ids)
+    return movies
+
+
+def popular_key(page=1, language=None):
+    """
+    Cache key of a popular list page.
+    """
+    return ('/movie/popular', page, language or app.config['TMDB_LANGUAGE'])
+
+
+def popular_page(page=1, language=None):
+    """
+    Gets a page of popular movies from the cache, already stored in the database.
+    """
+    language = language or app.config['TMDB_LANGUAGE']
+    key = popular_key(page, language)
+    return popular_cache.get(key, lambda: popular_flight.do(key, lambda: _load_popular_page(page, language)))
+
+
+def movies_in_order(movie_ids):
+    """
+    The stored movies with these ids in one query, in the order given.
+    """
+    if not movie_ids:
+        return []
+    by_id = {movie.id: movie for movie in db.session.scalars(select(Movie).where(Movie.id.in_(movie_ids)))}
+    return [by_id[movie_id] for movie_id in movie_ids if movie_id in by_id]
+
+
+def local_popular_movies(page=1, per_page=20):
+    """
+    Popular movies from the database alone, for when TMDb can't be reached.
+    Most liked first, newest releases after that.
+    """
+    return list(db.session.scalars(
+        select(Movie)
+        .order_by(Movie.like_count.desc(), Movie.release_date.desc())
+        .limit(per_page)
+        .offset((page - 1) * per_page)
+    ))
+
+
+def contains_pattern(text):
+    """
+    A LIKE pattern matching text anywhere, with its wildcards escaped by a backslash.
+    """
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def local_search(query, limit=20):
+    """
+    Searches stored movie titles, for when TMDb can't be reached.
+    """
+    return list(db.session.scalars(
+        select(Movie)
+        .where(Movie.title.ilike(contains_pattern(query), escape='\\'))
+        .order_by(Movie.release_date.desc())
+        .limit(limit)
+    ))
+
+
+def movie_dict(movie):
+    """
+    The TMDb result fields the movie cards use, plus its like and review figures, for a stored movie.
+    """
+    return {
+        'id': movie.id,
+        'title': movie.title,
+        'poster_path': movie.poster_path,
+        'overview': movie.overview or '',
+        'release_date': movie.release_date.isoformat(),
+        'like_count': movie.like_count,
+        'review_count': movie.review_count,
+        'average_rating': movie.average_rating,
+    }
+
+
+def _fetch_genre_names(language):
+    """
+    Fetches TMDb's genre list in language, into the genres table when it's
+    TMDB_LANGUAGE. Runs on the enricher pool, after a failure the list is fetched again once the breaker has had time to reset.
+    """
+    try:
+        genres = tmdb.client.get('/genre/movie/list', language=language).get('genres', [])
+    except requests.RequestException as error:
+        app.logger.warning('Fetching the genre list failed: %s', error)
+        with _genre_fetches_lock:
+            _genre_fetches[language] = time.monotonic() - app.config['TMDB_GENRE_CACHE_TTL'] + app.config['TMDB_BREAKER_RESET']
+        return
+
+    if language == app.config['TMDB_LANGUAGE']:
+        with app.app_context():
+            for genre in genres:
+                db.session.merge(Genre(id=genre['id'], name=genre['name']))
+            db.session.commit()
+    else:
+        with _genre_fetches_lock:
+            _genre_translations[language] = {genre['id']: genre['name'] for genre in genres}
+    genre_cache.invalidate(('/genre/movie/list', language))
+
+
+def _schedule_genre_fetch(language):
+    """
+    Queues a background fetch of TMDb's genre list if this process hasn't
+    fetched it within TMDB_GENRE_CACHE_TTL.
+    """
+    now = time.monotonic()
+    with _genre_fetches_lock:
+        fetched_at = _genre_fetches.get(language)
+        if fetched_at is not None and now - fetched_at < app.config['TMDB_GENRE_CACHE_TTL']:
+            return
+        _genre_fetches[language] = now
+    enricher.executor.submit(_fetch_genre_names, language)
+
+
+def _local_genre_names(language):
+    names = {genre.id: genre.name for genre in db.session.scalars(select(Genre).where(Genre.name.isnot(None)))}
+    # Until a language's list has been fetched its genres keep their default names
+    with _genre_fetches_lock:
+        names.update(_genre_translations.get(language, {}))
+    return names
+
+
+def genre_names(language=None):
+    """
+    Maps genre ids to names in language. The genres table holds them in
+    TMDB_LANGUAGE, TMDb's list is fetched in the background, a request never waits on it.
+    """
+    language = language or app.config['TMDB_LANGUAGE']
+    _schedule_genre_fetch(language)
+    return genre_cache.get(('/genre/movie/list', language), lambda: _local_genre_names(language))
+
+
+def movies_in_genre(genre_id, page=1, per_page=20):
+    """
+    A page of stored movies in a genre, found through the (genre_id, movie_id) index.
+    """
+    return list(db.session.scalars(
+        select(Movie)
+        .join(movie_genres, movie_genres.c.movie_id == Movie.id)
+        .where(movie_genres.c.genre_id == genre_id)
+        .order_by(movie_genres.c.movie_id.desc())
+        .limit(per_page)
+        .offset((page - 1) * per_page)
+    ))
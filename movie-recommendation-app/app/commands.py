@@ -0,0 +1,283 @@
+import gzip
+import json
+import os
+import time
+
+import click
+from werkzeug.serving import run_simple
+
+from app import app, db
+from app.models import Movie
+from app.catalog import insert_ignore, movie_row, genre_ids, store_movie_genres, reconcile_aggregates
+from app.fake_tmdb import create_fake_tmdb
+from app.sync import sync_changes
+from app.tmdb import TMDbUnavailable
+from app.query_plans import hot_queries, query_plan, full_scans
+from app.recommender import build_recommendations
+from app.like_events import apply_like_events, build_lock, latest_event_id, reset_after_build
+from app.als import train_ratings
+from app.content import build_content_index
+
+
+def _open_catalog(path):
+    """
+    Opens a JSON-lines catalog file, gzipped or not, as a text stream.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as checkpoint_file:
+            return json.load(checkpoint_file)['lines']
+    except (OSError, ValueError, KeyError):
+        return 0
+
+
+def _write_checkpoint(path, lines):
+    # Replace the file atomically so an interrupted run never leaves a torn checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump({'lines': lines}, checkpoint_file)
+    os.replace(tmp_path, path)
+
+
+@app.cli.command('import-catalog')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=10000, show_default=True, help='Rows per transaction.')
+@click.option('--checkpoint', 'checkpoint_path', default=None,
+              help='Checkpoint file, defaults to PATH.checkpoint.')
+@click.option('--restart', is_flag=True, help='Ignore an existing checkpoint and start from the top.')
+def import_catalog(path, batch_size, checkpoint_path, restart):
+    """
+    Imports movies from a JSON-lines catalog dump, such as TMDb's daily movie_ids export.
+
+    The file is streamed, so memory use stays flat however big it is. Rows are
+    inserted in batches, one transaction each, and movies that already exist are
+    skipped. After every batch the line count is checkpointed, so an interrupted
+    import carries on where it stopped when run again.
+    """
+    stmt = insert_ignore(Movie, 'id')
+    if stmt is None:
+        raise click.ClickException('import-catalog needs a SQLite or PostgreSQL database.')
+
+    checkpoint_path = checkpoint_path or path + '.checkpoint'
+    resume_from = 0 if restart else _read_checkpoint(checkpoint_path)
+    if resume_from:
+        click.echo(f'Resuming after line {resume_from:,}')
+
+    lines = skipped = 0
+    batch = []
+    batch_genres = {}
+    started = time.monotonic()
+
+    with db.engine.connect() as connection:
+        if db.engine.dialect.name == 'sqlite':
+            # Safe against application crashes, a lot faster than the default FULL
+            connection.exec_driver_sql('PRAGMA synchronous = NORMAL')
+            connection.commit()
+
+        def flush():
+            if batch:
+                with connection.begin():
+                    connection.execute(stmt, batch)
+                    store_movie_genres(batch_genres, connection)
+                batch.clear()
+                batch_genres.clear()
+            _write_checkpoint(checkpoint_path, lines)
+            rate = (lines - resume_from) / max(time.monotonic() - started, 1e-6)
+            click.echo(f'{lines:,} lines read, {skipped:,} skipped, {rate:,.0f} lines/s')
+
+        with _open_catalog(path) as catalog_file:
+            for line in catalog_file:
+                lines += 1
+                if lines <= resume_from:
+                    continue
+
+                # Skip blank or malformed lines rather than abort a long import
+                try:
+                    record = json.loads(line)
+                    batch.append(movie_row(record))
+                except (ValueError, KeyError, TypeError):
+                    skipped += 1
+                    continue
+
+                # ID exports have no genres, but full TMDb-shaped records do
+                ids = genre_ids(record)
+                if ids:
+                    batch_genres[record['id']] = ids
+
+                if len(batch) >= batch_size:
+                    flush()
+
+        flush()
+
+    click.echo(f'Import finished in {time.monotonic() - started:.1f}s')
+
+
+@app.cli.command('sync-changes')
+@click.option('--workers', default=8, show_default=True, help='Concurrent TMDb detail requests.')
+@click.option('--batch-size', default=500, show_default=True, help='Movies updated per transaction.')
+def sync_changes_command(workers, batch_size):
+    """
+    Refreshes stored movies that changed on TMDb since the last sync, meant to run from cron.
+    """
+    try:
+        updated, failed = sync_changes(workers=workers, batch_size=batch_size, log=click.echo)
+    except TMDbUnavailable as error:
+        raise click.ClickException(f'Sync stopped, TMDb is unavailable ({error}). The next run covers the same window.')
+    click.echo(f'Sync finished, {updated:,} movies updated, {failed:,} failed and left for the next run')
+
+
+@app.cli.command('fake-tmdb')
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=8001, show_default=True)
+@click.option('--latency', default=0.0, show_default=True, help='Added delay per request, in ms.')
+@click.option('--jitter', default=0.0, show_default=True, help='Random +/- spread on the delay, in ms.')
+@click.option('--error-rate', default=0.0, show_default=True, help='Fraction of requests that fail.')
+@click.option('--error-status', default=500, show_default=True, help='Status code of injected failures.')
+@click.option('--catalog-size', default=10000, show_default=True, help='Number of synthetic movies.')
+@click.option('--record', 'record_dir', default=None, help='Proxy to TMDb and save responses to this directory.')
+@click.option('--replay', 'replay_dir', default=None, help='Serve responses saved by --record from this directory.')
+def fake_tmdb_command(host, port, latency, jitter, error_rate, error_status, catalog_size, record_dir, replay_dir):
+    """
+    Runs a stand-in TMDb API for offline load testing.
+
+    Point the app at it with TMDB_URL=http://HOST:PORT/3.
+    """
+    if record_dir and replay_dir:
+        raise click.UsageError('--record and --replay cannot be used together.')
+    mode = 'record' if record_dir else 'replay' if replay_dir else 'synthetic'
+
+    fake = create_fake_tmdb(
+        latency=latency / 1000, jitter=jitter / 1000, error_rate=error_rate,
+        error_status=error_status, catalog_size=catalog_size, mode=mode,
+        cassette_dir=record_dir or replay_dir,
+    )
+    click.echo(f'Fake TMDb ({mode}) on http://{host}:{port}/3')
+    run_simple(host, port, fake, threaded=True)
+
+
+@app.cli.command('check-query-plans')
+@click.option('--verbose', '-v', is_flag=True, help='Print every plan, not just the failures.')
+def check_query_plans(verbose):
+    """
+    Checks that no hot query falls back to a full table scan.
+
+    Runs EXPLAIN QUERY PLAN on each query in app.query_plans and exits with
+    an error if one scans a table it isn't expected to, e.g. after an index
+    was dropped or a query changed shape.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('check-query-plans reads SQLite query plans.')
+
+    failures = 0
+    for name, statement, expected_scan in hot_queries():
+        plan = query_plan(statement)
+        scans = full_scans(plan)
+
+        if scans and not expected_scan:
+            failures += 1
+            click.echo(f'FAIL  {name}')
+        elif verbose:
+            click.echo(f'ok    {name}' + (f' (full scan expected: {expected_scan})' if scans else ''))
+        else:
+            continue
+
+        for line in plan:
+            click.echo(f'        {line}')
+
+    if failures:
+        raise click.ClickException(f'{failures} hot queries do a full table scan.')
+    click.echo('No unexpected full table scans.')
+
+
+@app.cli.command('reconcile-aggregates')
+def reconcile_aggregates_command():
+    """
+    Recounts every movie's likes, reviews and rating sum from the like and review tables.
+
+    The counts are kept up to date as users like and review, this repairs
+    them after rows were changed some other way, such as by hand.
+    """
+    started = time.monotonic()
+    fixed = reconcile_aggregates()
+    db.session.commit()
+    click.echo(f'{fixed:,} movies corrected in {time.monotonic() - started:.1f}s')
+
+
+@app.cli.command('build-recommendations')
+@click.option('--k', default=None, type=int, help='Neighbours kept per movie, defaults to RECOMMENDATIONS_K.')
+@click.option('--min-support', default=1, show_default=True,
+              help='Ignore pairs of movies liked together by fewer users than this.')
+def build_recommendations_command(k, min_support):
+    """
+    Rebuilds the item-item neighbour lists /recommendations serves from.
+
+    The consumer keeps them current between builds, so this is only needed
+    to start off or to fold a large overlay back into the build file.
+    """
+    # The consumer waits until the reset is committed, events it hasn't
+    # applied by then are applied on top of the new build
+    with build_lock():
+        # Like events up to here are in the likes the build reads
+        last_event_id = latest_event_id()
+        movies = build_recommendations(k=k, min_support=min_support, log=click.echo)
+        reset_after_build(last_event_id)
+        db.session.commit()
+    click.echo(f'Recommendations built for {movies:,} movies')
+
+
+@app.cli.command('build-content-index')
+def build_content_index_command():
+    """
+    Rebuilds the overview TF-IDF index behind "More Like This".
+
+    Movies stored after a build are added to every worker's copy as they
+    come in, a rebuild folds them in and reweighs every word.
+    """
+    movies = build_content_index(log=click.echo)
+    click.echo(f'Content index built for {movies:,} movies')
+
+
+@app.cli.command('recommendations-consumer')
+@click.option('--batch-size', default=1000, show_default=True, help='Like events applied per transaction.')
+@click.option('--interval', default=1.0, show_default=True, help='Seconds to wait when there are no events.')
+@click.option('--once', is_flag=True, help='Apply the events waiting now and exit.')
+def recommendations_consumer(batch_size, interval, once):
+    """
+    Applies likes and unlikes to the recommendation neighbour lists as they happen.
+
+    Runs until stopped, one per deployment. A new like shows up in
+    recommendations within about a batch's processing time plus the interval.
+    """
+    while True:
+        started = time.monotonic()
+        events, movies = apply_like_events(batch_size)
+        if events:
+            click.echo(f'{events:,} like events applied, {movies:,} neighbour lists updated '
+                       f'in {time.monotonic() - started:.2f}s')
+        if events < batch_size:
+            if once:
+                break
+            time.sleep(interval)
+
+
+@app.cli.command('train-als')
+@click.option('--warm', is_flag=True, help='Only refit the users and movies reviewed since the last run.')
+@click.option('--factors', default=None, type=int, help='Factors per user and movie, defaults to ALS_FACTORS.')
+@click.option('--iterations', default=None, type=int, help='Sweeps over the ratings, defaults to ALS_ITERATIONS.')
+@click.option('--workers', default=None, type=int, help='Solver processes, defaults to one per CPU.')
+def train_als_command(warm, factors, iterations, workers):
+    """
+    Trains the rating model the movie page predicts ratings from.
+
+    Run it in full now and then, and with --warm as often as new reviews
+    should show up. A warm run without a model trains in full.
+    """
+    started = time.monotonic()
+    reviews = train_ratings(warm=warm, factors=factors, iterations=iterations, workers=workers, log=click.echo)
+    db.session.commit()
+    click.echo(f'Rating model trained on {reviews:,} reviews in {time.monotonic() - started:.1f}s')
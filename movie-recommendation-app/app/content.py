@@ -0,0 +1,476 @@
+"""
+"More like this" from the words of movie overviews.
+
+Each overview becomes a TF-IDF vector: log scaled word counts weighted by
+how rare each word is in the catalog, scaled to unit length, so the dot
+product of two vectors is their cosine similarity. The inverted index lists
+the movies using each word, heaviest first. A query only walks the front of
+the postings of its heaviest words, so it scores a few thousand movies
+rather than the whole catalog.
+
+The word weights are fixed when the index is built. Movies added after that
+are weighted with them, and words first seen since get the weight of a word
+used once. `flask build-content-index` refreshes both.
+"""
+import collections
+import math
+import os
+import re
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import delete, func, select
+
+from app import app, db
+from app.artifacts import ArtifactFile, write_artifact
+from app.metrics import Counter, register
+from app.models import Movie, MovieAddition
+
+TOKEN_PATTERN = re.compile(r'[^\W_]+')
+STOP_WORDS = frozenset('''
+    a about after all also an and any are as at be been before but by can for from had has have he her his
+    how in into is it its just more no not now of on one or out over she so than that the their them then
+    there they this to up was what when where which while who will with would you your
+'''.split())
+# Heaviest words of a movie that are looked up, and postings read per word
+QUERY_TERMS = 30
+MAX_POSTINGS = 1000
+# Times k best partial scores that are rescored with every word
+RESCORE = 10
+# How often a worker checks for movies other workers stored
+REFRESH_SECONDS = 30
+# Movies added since the build that are scored directly, past this the index is rebuilt
+MAX_ADDED = 5000
+# Ids per IN (...) query, well under SQLite's bound parameter limit
+CHUNK_SIZE = 500
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall((text or '').lower())
+            if len(token) > 1 and token not in STOP_WORDS]
+
+
+def _term_counts(text, vocabulary, grow):
+    """
+    (column, count) arrays of the words of text. New words get a column when
+    grow is set and are dropped otherwise.
+    """
+    counts = collections.Counter()
+    for token in tokenize(text):
+        column = vocabulary.get(token)
+        if column is None and grow:
+            column = vocabulary.setdefault(token, len(vocabulary))
+        if column is not None:
+            counts[column] += 1
+    return np.fromiter(counts.keys(), dtype=np.int32), np.fromiter(counts.values(), dtype=np.float32)
+
+
+def _normalise_rows(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1), dtype=np.float32).ravel())
+    norms[norms == 0] = 1
+    matrix.data /= np.repeat(norms, np.diff(matrix.indptr))
+    return matrix
+
+
+def _impact_ordered(matrix):
+    """
+    The transpose of a CSR matrix, with each row's entries heaviest first.
+    """
+    postings = matrix.T.tocsr()
+    rows = np.repeat(np.arange(postings.shape[0]), np.diff(postings.indptr))
+    order = np.lexsort((-postings.data, rows))
+    postings.indices = postings.indices[order]
+    postings.data = postings.data[order]
+    return postings
+
+
+def build_index(movie_ids, overviews):
+    """
+    A ContentIndex of the given movies, from parallel sequences of ids and overviews.
+    """
+    movie_ids = np.asarray(movie_ids, dtype=np.int64)
+    order = np.argsort(movie_ids, kind='stable')
+    overviews = list(overviews)
+
+    vocabulary = {}
+    columns, counts, indptr = [], [], [0]
+    for overview in (overviews[position] for position in order.tolist()):
+        row_columns, row_counts = _term_counts(overview, vocabulary, grow=True)
+        columns.append(row_columns)
+        counts.append(row_counts)
+        indptr.append(indptr[-1] + len(row_columns))
+
+    n_movies = len(indptr) - 1
+    counts = np.concatenate(counts) if counts else np.empty(0, dtype=np.float32)
+    matrix = sparse.csr_matrix(
+        (1 + np.log(counts), np.concatenate(columns) if columns else np.empty(0, dtype=np.int32), indptr),
+        shape=(n_movies, len(vocabulary)), dtype=np.float32,
+    )
+
+    # Smoothed IDF, a word in every overview still weighs a little
+    document_frequency = np.bincount(matrix.indices, minlength=len(vocabulary))
+    idf = (np.log((1 + n_movies) / (1 + document_frequency)) + 1).astype(np.float32)
+    matrix.data *= idf[matrix.indices]
+    matrix = _normalise_rows(matrix)
+    return ContentIndex(movie_ids[order], vocabulary, idf, matrix, _impact_ordered(matrix))
+
+
+class ContentIndex:
+    """
+    TF-IDF vectors of the movies indexed at build time, their postings, and
+    the vectors of movies added since, which are scored directly.
+    """
+
+    def __init__(self, movie_ids, vocabulary, idf, matrix, postings):
+        # In ascending order, rows are found by binary search
+        self.movie_ids = movie_ids
+        self.vocabulary = vocabulary
+        self.idf = idf
+        # Weight of words new since the build, as if used in one overview
+        self.new_word_idf = math.log((1 + len(movie_ids)) / 2) + 1
+        self.matrix = matrix
+        self.postings = postings
+        # Ids and vectors of the movies added since, swapped together so a
+        # concurrent query sees either the old or the new set
+        self.added = (np.empty(0, dtype=np.int64), sparse.csr_matrix((0, len(vocabulary)), dtype=np.float32))
+
+    def __len__(self):
+        return len(self.movie_ids) + len(self.added[0])
+
+    def full(self):
+        return len(self.added[0]) >= MAX_ADDED
+
+    def vectorize(self, text, grow=False):
+        """
+        The unit length TF-IDF vector of a text, as (columns, weights) arrays.
+        """
+        columns, counts = _term_counts(text, self.vocabulary, grow)
+        weights = (1 + np.log(counts)) * np.array(
+            [self.idf[column] if column < len(self.idf) else self.new_word_idf for column in columns.tolist()],
+            dtype=np.float32,
+        )
+        norm = np.sqrt(np.dot(weights, weights))
+        return columns, weights / norm if norm else weights
+
+    def _row(self, movie_id):
+        row = int(np.searchsorted(self.movie_ids, movie_id))
+        return row if row < len(self.movie_ids) and self.movie_ids[row] == movie_id else None
+
+    def vector_of(self, movie_id):
+        """
+        A movie's stored vector as (columns, weights), or None if it isn't indexed.
+        """
+        row = self._row(movie_id)
+        if row is not None:
+            start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+            return self.matrix.indices[start:end], self.matrix.data[start:end]
+        added_ids, added = self.added
+        position = np.nonzero(added_ids == movie_id)[0]
+        if len(position):
+            vector = added[position[0]]
+            return vector.indices, vector.data
+        return None
+
+    def add(self, movies):
+        """
+        Adds (movie_id, overview) pairs, skipping movies already indexed,
+        until MAX_ADDED movies have been added since the build.
+        """
+        added_ids, added = self.added
+        indptr, columns, weights, ids = [0], [], [], []
+        known = set(added_ids.tolist())
+        for movie_id, overview in movies:
+            if len(known) >= MAX_ADDED:
+                break
+            if movie_id in known or self._row(movie_id) is not None:
+                continue
+            row_columns, row_weights = self.vectorize(overview, grow=True)
+            ids.append(movie_id)
+            columns.append(row_columns)
+            weights.append(row_weights)
+            indptr.append(indptr[-1] + len(row_columns))
+            known.add(movie_id)
+        if not ids:
+            return 0
+
+        # The existing rows are widened to the grown vocabulary, not resized in place
+        shape = (len(added_ids), len(self.vocabulary))
+        new_rows = sparse.csr_matrix(
+            (np.concatenate(weights), np.concatenate(columns), indptr),
+            shape=(len(ids), shape[1]), dtype=np.float32,
+        )
+        added = sparse.csr_matrix((added.data, added.indices, added.indptr), shape=shape)
+        self.added = (np.concatenate([added_ids, ids]), sparse.vstack([added, new_rows], format='csr'))
+        return len(ids)
+
+    def more_like_this(self, movie_id, overview, k=10):
+        """
+        Up to k (movie_id, score) pairs of the movies whose overviews are most
+        like this one, best first. Only the QUERY_TERMS heaviest words of the
+        overview and the first MAX_POSTINGS movies using each are looked at.
+        """
+        vector = self.vector_of(movie_id)
+        columns, weights = vector if vector is not None else self.vectorize(overview)
+        if not len(columns):
+            return []
+
+        # Accumulate scores over the front of each heavy word's postings
+        top = np.argsort(-weights, kind='stable')[:QUERY_TERMS]
+        candidate_rows, contributions = [], []
+        for column, weight in zip(columns[top].tolist(), weights[top].tolist()):
+            if column >= self.postings.shape[0]:
+                continue
+            start = self.postings.indptr[column]
+            end = min(self.postings.indptr[column + 1], start + MAX_POSTINGS)
+            candidate_rows.append(self.postings.indices[start:end])
+            contributions.append(self.postings.data[start:end] * weight)
+
+        candidate_ids, scores = [], []
+        if candidate_rows:
+            rows, positions = np.unique(np.concatenate(candidate_rows), return_inverse=True)
+            partial = np.bincount(positions, weights=np.concatenate(contributions))
+
+            # The partial sums leave out light words, so the best few are scored in full
+            if len(rows) > k * RESCORE:
+                keep = np.argpartition(-partial, k * RESCORE - 1)[:k * RESCORE]
+                rows = rows[keep]
+            query = np.zeros(self.matrix.shape[1], dtype=np.float32)
+            in_range = columns < self.matrix.shape[1]
+            query[columns[in_range]] = weights[in_range]
+            candidate_ids.append(self.movie_ids[rows])
+            scores.append(self.matrix[rows] @ query)
+
+        # Movies added since the build are few, they're compared with every word
+        added_ids, added = self.added
+        if len(added_ids):
+            query = np.zeros(added.shape[1], dtype=np.float32)
+            in_range = columns < added.shape[1]
+            query[columns[in_range]] = weights[in_range]
+            candidate_ids.append(added_ids)
+            scores.append(added @ query)
+        if not candidate_ids:
+            return []
+
+        candidate_ids = np.concatenate(candidate_ids)
+        scores = np.concatenate(scores)
+        scores[candidate_ids == movie_id] = 0
+        k = min(k, int(np.count_nonzero(scores > 0)))
+        if not k:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return [(int(candidate_ids[i]), float(scores[i])) for i in best]
+
+
+def load_overviews(movie_ids=None):
+    """
+    (ids, overviews) of every movie, or of movie_ids, in id order.
+    """
+    query = select(Movie.id, Movie.overview).order_by(Movie.id)
+    if movie_ids is None:
+        # Straight from the driver cursor, the whole catalog can be a lot of rows
+        sql = str(query.compile(dialect=db.engine.dialect))
+        with db.engine.connect() as connection:
+            cursor = connection.connection.cursor()
+            try:
+                cursor.execute(sql)
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+    else:
+        movie_ids = list(movie_ids)
+        rows = []
+        for start in range(0, len(movie_ids), CHUNK_SIZE):
+            rows.extend(db.session.execute(query.where(Movie.id.in_(movie_ids[start:start + CHUNK_SIZE]))))
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+
+def save_index(path, index, added_through=0):
+    """
+    Writes an index as an artifact, swapped in atomically. Movies added
+    since its build are left out, workers pick them up from the movie_additions
+    rows after added_through.
+    """
+    terms = sorted(index.vocabulary, key=index.vocabulary.get)[:len(index.idf)]
+    write_artifact(path, 'content', {
+        'added_through': np.array([added_through], dtype=np.int64),
+        'movie_ids': index.movie_ids.astype(np.int64),
+        # Words are plain letters and digits, so a newline can separate them
+        'terms': np.frombuffer('\n'.join(terms).encode(), dtype=np.uint8),
+        'idf': index.idf.astype(np.float32),
+        'matrix_indptr': index.matrix.indptr, 'matrix_indices': index.matrix.indices,
+        'matrix_data': index.matrix.data,
+        'postings_indptr': index.postings.indptr, 'postings_indices': index.postings.indices,
+        'postings_data': index.postings.data,
+    })
+
+
+def index_from(artifact):
+    """
+    A ContentIndex over the mapped arrays of an artifact. Only the vocabulary
+    is copied into the worker.
+    """
+    terms = artifact['terms'].tobytes().decode().split('\n') if len(artifact['terms']) else []
+    shape = (len(artifact['movie_ids']), len(terms))
+    matrix = sparse.csr_matrix(
+        (artifact['matrix_data'], artifact['matrix_indices'], artifact['matrix_indptr']), shape=shape)
+    postings = sparse.csr_matrix(
+        (artifact['postings_data'], artifact['postings_indices'], artifact['postings_indptr']), shape=shape[::-1])
+    return ContentIndex(artifact['movie_ids'], {term: column for column, term in enumerate(terms)},
+                        artifact['idf'], matrix, postings)
+
+
+class ContentRecommender:
+    """
+    The index this worker answers from, mapped from the file
+    build-content-index writes and remapped when that's replaced. While there
+    is no file, one worker builds it in the background and queries find
+    nothing. Movies stored since the build are read from the movie_additions
+    log within REFRESH_SECONDS of a query. Once MAX_ADDED of them have been
+    added the index is rebuilt in the background.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = ArtifactFile(path, 'content')
+        self.stats = Counter('requests', 'not_ready', 'builds', 'build_errors', 'added')
+        self._lock = threading.Lock()
+        self._artifact = None
+        self._index = None
+        # Last movie_additions row read into the index
+        self._added_through = 0
+        self._next_refresh = 0
+        self._builder = None
+        self._next_build = 0
+
+    def _current(self):
+        artifact = self.file.current()
+        if artifact is None:
+            self._start_build(None)
+            return None
+        if artifact is not self._artifact:
+            with self._lock:
+                if artifact is not self._artifact:
+                    self._index = index_from(artifact)
+                    added_through = artifact.arrays.get('added_through')
+                    self._added_through = int(added_through[0]) if added_through is not None else 0
+                    self._artifact = artifact
+                    self._next_refresh = 0
+        self._refresh()
+        return self._index
+
+    def _refresh(self):
+        """
+        Adds movies other workers stored, checking at most every REFRESH_SECONDS.
+        """
+        if time.monotonic() < self._next_refresh:
+            return
+        with self._lock:
+            if time.monotonic() < self._next_refresh:
+                return
+            self._next_refresh = time.monotonic() + REFRESH_SECONDS
+            index, artifact = self._index, self._artifact
+            while not index.full():
+                rows = db.session.execute(
+                    select(MovieAddition.id, MovieAddition.movie_id)
+                    .where(MovieAddition.id > self._added_through)
+                    .order_by(MovieAddition.id)
+                    .limit(CHUNK_SIZE)
+                ).all()
+                if not rows:
+                    break
+                self.stats.inc('added', index.add(zip(*load_overviews([row.movie_id for row in rows]))))
+                self._added_through = rows[-1].id
+        if index.full():
+            self._start_build(artifact)
+
+    def _start_build(self, stale):
+        """
+        Builds the index in a background thread unless one is running, or
+        has been started within REFRESH_SECONDS. stale is the artifact the
+        build replaces, None if there is no file yet.
+        """
+        with self._lock:
+            if (self._builder is not None and self._builder.is_alive()) or time.monotonic() < self._next_build:
+                return
+            self._next_build = time.monotonic() + REFRESH_SECONDS
+            self._builder = threading.Thread(target=self._build, args=(stale,), name='content-index', daemon=True)
+            self._builder.start()
+
+    def _build(self, stale):
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path + '.lock', 'w') as lock_file:
+                # One worker builds, the others map the file it writes
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        return
+                current = self.file.current()
+                if current is not None and (stale is None or current.version != stale.version):
+                    return
+                with app.app_context():
+                    build_content_index(log=lambda message: app.logger.info('Content index: %s', message))
+            self.stats.inc('builds')
+        except Exception:
+            self.stats.inc('build_errors')
+            app.logger.exception('Building the content index failed')
+
+    def add(self, movie_ids):
+        """
+        Indexes newly stored movies, reading their overviews from the database.
+        """
+        if not movie_ids or self._index is None:
+            return
+        movies = list(zip(*load_overviews(movie_ids)))
+        with self._lock:
+            self.stats.inc('added', self._index.add(movies))
+
+    def more_like_this(self, movie_id, overview, k=10):
+        self.stats.inc('requests')
+        index = self._current()
+        if index is None:
+            self.stats.inc('not_ready')
+            return []
+        return index.more_like_this(movie_id, overview, k)
+
+    def snapshot(self):
+        stats = self.stats.snapshot()
+        index, artifact, builder = self._index, self._artifact, self._builder
+        stats['loads'] = self.file.loads
+        stats['movies'] = len(index) if index is not None else 0
+        stats['words'] = len(index.vocabulary) if index is not None else 0
+        stats['built_at'] = artifact.version / 1e9 if artifact is not None else None
+        stats['building'] = builder is not None and builder.is_alive()
+        return stats
+
+
+content_index = register('content_index', ContentRecommender(app.config['CONTENT_INDEX_PATH']))
+
+
+def build_content_index(log=print):
+    """
+    Rebuilds the index from every movie's overview and saves it.
+    """
+    # Movies logged up to here are read below, later ones are left to the workers
+    added_through = db.session.scalar(select(func.max(MovieAddition.id))) or 0
+    started = time.monotonic()
+    movie_ids, overviews = load_overviews()
+    log(f'{len(movie_ids):,} overviews read in {time.monotonic() - started:.1f}s')
+
+    built = time.monotonic()
+    index = build_index(movie_ids, overviews)
+    log(f'{index.matrix.nnz:,} postings of {len(index.vocabulary):,} words built in {time.monotonic() - built:.1f}s')
+
+    save_index(app.config['CONTENT_INDEX_PATH'], index, added_through)
+    db.session.execute(delete(MovieAddition).where(MovieAddition.id <= added_through))
+    db.session.commit()
+    return len(movie_ids)
@@ -0,0 +1,112 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from sqlalchemy import update
+
+from app import app, db
+from app.metrics import Counter, register
+from app.models import Movie
+from app.tmdb import client
+
+# How much of each appended list is kept
+MAX_CAST = 8
+MAX_KEYWORDS = 10
+
+
+def fetch_details(movie_id):
+    """
+    Gets a movie with its credits, keywords and videos in a single TMDb call,
+    or None if TMDb doesn't have it.
+    """
+    try:
+        return client.get(f'/movie/{movie_id}', append_to_response='credits,keywords,videos')
+    except requests.HTTPError as error:
+        if error.response is not None and error.response.status_code == 404:
+            return None
+        raise
+
+
+def detail_columns(movie_data):
+    """
+    Boils a detail response down to the runtime and details columns.
+    """
+    credits = movie_data.get('credits', {})
+    cast = sorted(credits.get('cast', []), key=lambda member: member.get('order', 0))
+    trailers = [
+        video['key'] for video in movie_data.get('videos', {}).get('results', [])
+        if video.get('site') == 'YouTube' and video.get('type') == 'Trailer'
+    ]
+    return {
+        'runtime': movie_data.get('runtime') or None,
+        'details': {
+            'cast': [member['name'] for member in cast[:MAX_CAST]],
+            'directors': [member['name'] for member in credits.get('crew', []) if member.get('job') == 'Director'],
+            'keywords': [keyword['name'] for keyword in movie_data.get('keywords', {}).get('keywords', [])[:MAX_KEYWORDS]],
+            'trailer': trailers[0] if trailers else None,
+        },
+    }
+
+
+class Enricher:
+    """
+    Fills in the details of newly stored movies on a small background pool,
+    so no page ever waits on TMDb for them.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.stats = Counter('queued', 'enriched', 'missing', 'errors')
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = None
+        self._pid = None
+
+    @property
+    def executor(self):
+        # Threads don't survive a fork, so each worker process gets its own pool
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='enrich')
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, movie_ids):
+        for movie_id in movie_ids:
+            with self._lock:
+                if movie_id in self._pending:
+                    continue
+                self._pending.add(movie_id)
+            self.stats.inc('queued')
+            self.executor.submit(self._enrich, movie_id)
+
+    def _enrich(self, movie_id):
+        try:
+            movie_data = fetch_details(movie_id)
+            if movie_data is None:
+                self.stats.inc('missing')
+                return
+            with app.app_context():
+                db.session.execute(update(Movie), [{'id': movie_id, **detail_columns(movie_data)}])
+                db.session.commit()
+            self.stats.inc('enriched')
+        except requests.RequestException as error:
+            self.stats.inc('errors')
+            app.logger.warning('Enriching movie %s failed: %s', movie_id, error)
+        except Exception:
+            self.stats.inc('errors')
+            app.logger.exception('Enriching movie %s failed', movie_id)
+        finally:
+            with self._lock:
+                self._pending.discard(movie_id)
+
+    def snapshot(self):
+        stats = self.stats.snapshot()
+        with self._lock:
+            stats['pending'] = len(self._pending)
+        return stats
+
+
+enricher = register('enrich', Enricher(app.config['ENRICH_WORKERS']))
@@ -0,0 +1,204 @@
+"""
+Stand-in TMDb server for load testing without the real API.
+
+In synthetic mode every response is generated from the request alone, so the
+same URL always returns the same data. In record mode requests are proxied to
+the real API and the responses saved to a cassette directory, which replay
+mode then serves back without any network access.
+"""
+import hashlib
+import json
+import os
+import random
+import time
+from datetime import date, timedelta
+
+import requests
+from flask import Flask, Response, jsonify, request
+
+PAGE_SIZE = 20
+GENRES = {
+    28: 'Action', 12: 'Adventure', 16: 'Animation', 35: 'Comedy', 80: 'Crime',
+    99: 'Documentary', 18: 'Drama', 10751: 'Family', 14: 'Fantasy', 36: 'History',
+    27: 'Horror', 10402: 'Music', 9648: 'Mystery', 10749: 'Romance', 878: 'Science Fiction',
+    53: 'Thriller', 10752: 'War', 37: 'Western',
+}
+WORDS = (
+    'lost city night return dark star heart last river storm secret house empire '
+    'garden shadow ocean winter fire road king summer glass iron silent wild'
+).split()
+
+
+def synthetic_movie(movie_id):
+    """
+    Builds a TMDb-shaped movie that only depends on its id.
+    """
+    rng = random.Random(movie_id)
+    title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title()
+    released = date(1950, 1, 1) + timedelta(days=rng.randrange(27000))
+    return {
+        'id': movie_id,
+        'title': title,
+        'original_title': title,
+        'genre_ids': rng.sample(sorted(GENRES), rng.randint(1, 3)),
+        'release_date': released.isoformat(),
+        'poster_path': f'/synthetic{movie_id}.jpg',
+        'overview': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 60))).capitalize() + '.',
+        'popularity': round(rng.uniform(1, 500), 3),
+        'vote_average': round(rng.uniform(1, 10), 1),
+        'vote_count': rng.randint(0, 20000),
+    }
+
+
+def _page(ids, page, total_results):
+    return {
+        'page': page,
+        'results': [synthetic_movie(movie_id) for movie_id in ids],
+        'total_pages': max(1, -(-total_results // PAGE_SIZE)),
+        'total_results': total_results,
+    }
+
+
+def _cassette_path(cassette_dir):
+    """
+    Cassette file for the current request, the API key is left out of the key.
+    """
+    query = sorted((k, v) for k, v in request.args.items(multi=True) if k != 'api_key')
+    name = hashlib.sha1(json.dumps([request.path, query]).encode()).hexdigest()
+    return os.path.join(cassette_dir, name + '.json')
+
+
+def _recording(upstream_response):
+    """
+    What a cassette stores for an upstream response: the parsed body if it's
+    JSON, otherwise the raw text and content type, such as a proxy's HTML
+    error page or an empty 204.
+    """
+    recorded = {'status': upstream_response.status_code}
+    if upstream_response.headers.get('Content-Type', '').split(';')[0].strip() == 'application/json':
+        try:
+            recorded['body'] = upstream_response.json()
+            return recorded
+        except ValueError:
+            pass
+    recorded['text'] = upstream_response.text
+    recorded['content_type'] = upstream_response.headers.get('Content-Type')
+    return recorded
+
+
+def _replayed(recorded):
+    if 'body' in recorded:
+        response = jsonify(recorded['body'])
+    else:
+        response = Response(recorded['text'], content_type=recorded['content_type'])
+    response.status_code = recorded['status']
+    return response
+
+
+def create_fake_tmdb(latency=0.0, jitter=0.0, error_rate=0.0, error_status=500,
+                     catalog_size=10000, mode='synthetic', cassette_dir=None,
+                     upstream='https://api.themoviedb.org'):
+    """
+    Creates the stand-in server. latency and jitter are in seconds, error_rate
+    is the fraction of requests answered with error_status instead.
+    """
+    fake = Flask('fake_tmdb')
+    first_id = 1000
+
+    @fake.before_request
+    def inject_latency_and_errors():
+        if latency or jitter:
+            time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+        if error_rate and random.random() < error_rate:
+            response = jsonify({'status_message': 'Injected error.', 'success': False})
+            response.status_code = error_status
+            if error_status == 429:
+                response.headers['Retry-After'] = '1'
+            return response
+
+        if mode == 'replay':
+            try:
+                with open(_cassette_path(cassette_dir)) as cassette:
+                    recorded = json.load(cassette)
+            except OSError:
+                response = jsonify({'status_message': 'Not in cassette.', 'success': False})
+                response.status_code = 404
+                return response
+            return _replayed(recorded)
+
+        if mode == 'record':
+            upstream_response = requests.get(upstream + request.path, params=request.args, timeout=30)
+            recorded = _recording(upstream_response)
+            os.makedirs(cassette_dir, exist_ok=True)
+            with open(_cassette_path(cassette_dir), 'w') as cassette:
+                json.dump(recorded, cassette)
+            return _replayed(recorded)
+
+    @fake.route('/3/movie/popular')
+    def popular():
+        page = request.args.get('page', 1, type=int)
+        total = min(catalog_size, 500 * PAGE_SIZE)
+        start = first_id + (page - 1) * PAGE_SIZE
+        ids = range(start, min(start + PAGE_SIZE, first_id + total))
+        return jsonify(_page(ids, page, total))
+
+    @fake.route('/3/search/movie')
+    def search():
+        query = request.args.get('query', '')
+        page = request.args.get('page', 1, type=int)
+
+        # Every query has its own stable set of matches
+        rng = random.Random(query.lower())
+        matches = sorted(rng.sample(range(first_id, first_id + catalog_size), min(catalog_size, rng.randint(0, 60))))
+        ids = matches[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+        data = _page(ids, page, len(matches))
+        for movie in data['results']:
+            movie['title'] = f"{query.title()} {movie['title']}"
+        return jsonify(data)
+
+    @fake.route('/3/movie/changes')
+    def changes():
+        page = request.args.get('page', 1, type=int)
+        end_date = request.args.get('end_date') or date.today().isoformat()
+
+        # A stable slice of the catalog changes every day
+        rng = random.Random(end_date)
+        changed = sorted(rng.sample(range(first_id, first_id + catalog_size), min(catalog_size, 300)))
+        per_page = 100
+        return jsonify({
+            'page': page,
+            'results': [{'id': movie_id, 'adult': False} for movie_id in changed[(page - 1) * per_page:page * per_page]],
+            'total_pages': -(-len(changed) // per_page),
+            'total_results': len(changed),
+        })
+
+    @fake.route('/3/genre/movie/list')
+    def genre_list():
+        return jsonify({'genres': [{'id': genre_id, 'name': name} for genre_id, name in GENRES.items()]})
+
+    @fake.route('/3/movie/<int:movie_id>')
+    def movie(movie_id):
+        if not first_id <= movie_id < first_id + catalog_size:
+            response = jsonify({'status_message': 'The resource you requested could not be found.', 'success': False})
+            response.status_code = 404
+            return response
+
+        movie_data = synthetic_movie(movie_id)
+        movie_data['genres'] = [{'id': genre_id, 'name': GENRES[genre_id]} for genre_id in movie_data.pop('genre_ids')]
+        rng = random.Random(movie_id)
+        movie_data['runtime'] = rng.randint(70, 200)
+
+        # Appended sub-resources, like the real API's append_to_response
+        appended = request.args.get('append_to_response', '').split(',')
+        if 'credits' in appended:
+            movie_data['credits'] = {
+                'cast': [{'name': f'Actor {rng.randrange(100000)}', 'order': order} for order in range(12)],
+                'crew': [{'name': f'Director {rng.randrange(10000)}', 'job': 'Director'}],
+            }
+        if 'keywords' in appended:
+            movie_data['keywords'] = {'keywords': [{'name': word} for word in rng.sample(WORDS, 5)]}
+        if 'videos' in appended:
+            movie_data['videos'] = {'results': [{'site': 'YouTube', 'type': 'Trailer', 'key': f'synthetic{movie_id}'}]}
+        return jsonify(movie_data)
+
+    return fake
@@ -0,0 +1,255 @@
+"""
+Keeps the recommendation neighbour lists current between full builds.
+
+like_movie and remove_like add a LikeEvent in the same transaction as the
+like. The consumer reads them in micro-batches. For each movie whose likes
+changed it recomputes that movie's similarities from the like table, through
+the (movie_id, user_id) and (user_id, movie_id) indexes, and stores its new
+top k. It then updates the movie's score in the lists of the movies it is
+similar to.
+The lists are written to item_neighbours, which overrides the last build.
+
+A full build replaces the overlay once it's done. It holds the build lock
+from before it reads the likes until the overlay is reset, and the consumer
+waits for that lock before each batch, so the consumer never writes lists
+that the reset then drops along with the events behind them.
+"""
+import heapq
+import math
+import os
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+from sqlalchemy import select, delete, func
+from sqlalchemy.orm import aliased
+
+from app import app, db
+from app.metrics import register
+from app.models import Like, LikeEvent, ItemNeighbour, Movie
+from app.recommender import recommender
+from app.sync import get_state, set_state
+
+WATERMARK_KEY = 'like_events'
+# Ids per IN (...) query, well under SQLite's bound parameter limit
+CHUNK_SIZE = 500
+
+
+@contextmanager
+def build_lock():
+    """
+    Exclusive lock between a full build and the consumer, held on a file
+    next to the build file. A crashed process releases it with its files.
+    """
+    path = app.config['RECOMMENDATIONS_PATH'] + '.lock'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def record_like_event(user_id, movie_id, delta):
+    """
+    Queues a like (delta 1) or unlike (delta -1) for the consumer. The caller
+    commits, in the same transaction as the like itself.
+    """
+    db.session.add(LikeEvent(user_id=user_id, movie_id=movie_id, delta=delta))
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def overlay_lists(movie_ids):
+    """
+    Neighbour lists updated since the last build for any of movie_ids,
+    as {movie_id: [(neighbour_id, score)]}.
+    """
+    lists = {}
+    for chunk in _chunks(movie_ids):
+        rows = db.session.execute(
+            select(ItemNeighbour.movie_id, ItemNeighbour.neighbour_id, ItemNeighbour.score)
+            .where(ItemNeighbour.movie_id.in_(chunk))
+        )
+        for movie_id, neighbour_id, score in rows:
+            pairs = lists.setdefault(movie_id, [])
+            if neighbour_id != movie_id:
+                pairs.append((neighbour_id, score))
+    return lists
+
+
+def similar_movies(movie_id, min_support=1):
+    """
+    Cosine similarity of a movie with every movie liked by someone who liked it,
+    using the like counts stored on each movie for the norms. Like the full
+    build, movies liked together by fewer than min_support users are left out.
+    """
+    own_likes = db.session.scalar(select(Movie.like_count).where(Movie.id == movie_id))
+    if not own_likes:
+        return {}
+
+    other = aliased(Like)
+    rows = db.session.execute(
+        select(other.movie_id, func.count(), Movie.like_count)
+        .select_from(Like)
+        .join(other, other.user_id == Like.user_id)
+        .join(Movie, Movie.id == other.movie_id)
+        .where(Like.movie_id == movie_id, other.movie_id != movie_id)
+        .group_by(other.movie_id, Movie.like_count)
+        .having(func.count() >= min_support)
+    )
+    return {
+        neighbour_id: co_likes / math.sqrt(own_likes * like_count)
+        for neighbour_id, co_likes, like_count in rows if like_count
+    }
+
+
+class NeighbourLists:
+    """
+    Current neighbour lists of the movies a batch touches: the updated list
+    if there is one, otherwise the row from the last build.
+    """
+
+    def __init__(self, k, min_support=1):
+        self.k = k
+        self.min_support = min_support
+        self.lists = {}
+        self.changed = set()
+
+    def load(self, movie_ids):
+        missing = [movie_id for movie_id in movie_ids if movie_id not in self.lists]
+        overlay = overlay_lists(missing)
+        for movie_id in missing:
+            if movie_id in overlay:
+                self.lists[movie_id] = dict(overlay[movie_id])
+            else:
+                self.lists[movie_id] = recommender.neighbours_of(movie_id)
+
+    def holders(self, movie_id):
+        """
+        Movies that list movie_id as a neighbour, in the overlay or the last build.
+        """
+        listed = set(db.session.scalars(select(ItemNeighbour.movie_id).where(ItemNeighbour.neighbour_id == movie_id)))
+        listed.update(recommender.holders_of(movie_id))
+        listed.discard(movie_id)
+        self.load(listed)
+        return {holder for holder in listed if movie_id in self.lists[holder]}
+
+    def refresh(self, movie_id):
+        """
+        Recomputes a movie's list and its entry in every list it belongs in.
+        """
+        similarities = similar_movies(movie_id, self.min_support)
+        self.lists[movie_id] = dict(heapq.nlargest(self.k, similarities.items(), key=lambda pair: pair[1]))
+        self.changed.add(movie_id)
+
+        # Similarity is symmetric, so the same scores go into the other movies' lists
+        candidates = set(similarities) | self.holders(movie_id)
+        self.load(candidates)
+        for other_id in candidates:
+            neighbours = self.lists[other_id]
+            score = similarities.get(other_id, 0.0)
+
+            if movie_id in neighbours:
+                if score > 0:
+                    neighbours[movie_id] = score
+                else:
+                    del neighbours[movie_id]
+            elif score > 0 and (len(neighbours) < self.k or score > min(neighbours.values())):
+                neighbours[movie_id] = score
+                if len(neighbours) > self.k:
+                    del neighbours[min(neighbours, key=neighbours.get)]
+            else:
+                continue
+            self.changed.add(other_id)
+
+    def save(self):
+        """
+        Writes the changed lists to item_neighbours. The caller commits.
+        """
+        for chunk in _chunks(self.changed):
+            db.session.execute(delete(ItemNeighbour).where(ItemNeighbour.movie_id.in_(chunk)))
+            rows = []
+            for movie_id in chunk:
+                neighbours = self.lists[movie_id] or {movie_id: 0.0}
+                rows.extend({'movie_id': movie_id, 'neighbour_id': neighbour_id, 'score': score}
+                            for neighbour_id, score in neighbours.items())
+            db.session.execute(ItemNeighbour.__table__.insert(), rows)
+
+
+def apply_like_events(batch_size=1000):
+    """
+    Applies the next batch of like events to the neighbour lists, waiting
+    for a full build to finish first. Returns (events applied, movies whose lists changed).
+    """
+    with build_lock():
+        return _apply_like_events(batch_size)
+
+
+def _apply_like_events(batch_size):
+    watermark = int(get_state(WATERMARK_KEY, 0))
+    events = db.session.execute(
+        select(LikeEvent.id, LikeEvent.movie_id)
+        .where(LikeEvent.id > watermark)
+        .order_by(LikeEvent.id)
+        .limit(batch_size)
+    ).all()
+    if not events:
+        return 0, 0
+
+    # Several likes of one movie in a batch only need one refresh
+    lists = NeighbourLists(app.config['RECOMMENDATIONS_K'], recommender.min_support())
+    for movie_id in sorted({event.movie_id for event in events}):
+        lists.refresh(movie_id)
+    lists.save()
+
+    # Move the watermark and drop the consumed events in the same transaction
+    last_id = events[-1].id
+    set_state(WATERMARK_KEY, str(last_id))
+    db.session.execute(delete(LikeEvent).where(LikeEvent.id <= last_id))
+    db.session.commit()
+    return len(events), len(lists.changed)
+
+
+def latest_event_id():
+    return db.session.scalar(select(func.max(LikeEvent.id))) or 0
+
+
+def reset_after_build(last_event_id):
+    """
+    Drops the overlay once a full build has replaced it. Events up to
+    last_event_id were in the likes the build read. The caller holds
+    build_lock() from before reading last_event_id until it has committed.
+    """
+    db.session.execute(delete(ItemNeighbour))
+    db.session.execute(delete(LikeEvent).where(LikeEvent.id <= last_event_id))
+    if last_event_id > int(get_state(WATERMARK_KEY, 0)):
+        set_state(WATERMARK_KEY, str(last_event_id))
+
+
+class ConsumerLag:
+    """
+    How far the consumer is behind, read from the database so every
+    worker reports the same thing.
+    """
+
+    def snapshot(self):
+        watermark = int(get_state(WATERMARK_KEY, 0))
+        pending, oldest = db.session.execute(
+            select(func.count(), func.min(LikeEvent.created_at)).where(LikeEvent.id > watermark)
+        ).one()
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return {
+            'pending_events': pending,
+            'lag_seconds': round((now - oldest).total_seconds(), 3) if oldest else 0.0,
+        }
+
+
+register('like_events', ConsumerLag())
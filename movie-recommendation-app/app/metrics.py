@@ -0,0 +1,81 @@
+import threading
+
+# Latency bucket upper bounds in milliseconds
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    """
+    Thread-safe fixed-bucket histogram, keyed by a label such as an endpoint.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, label, value):
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = {
+                    "count": 0,
+                    "sum": 0.0,
+                    "buckets": [0] * (len(self.buckets) + 1),
+                }
+            series["count"] += 1
+            series["sum"] += value
+
+            # Find the first bucket the value fits in, the last slot is +Inf
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+                    break
+            else:
+                series["buckets"][-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            labels = [str(bound) for bound in self.buckets] + ["+Inf"]
+            return {
+                label: {
+                    "count": series["count"],
+                    "sum": round(series["sum"], 3),
+                    "buckets": dict(zip(labels, series["buckets"])),
+                }
+                for label, series in self._series.items()
+            }
+
+
+class Counter:
+    """
+    Thread-safe group of named counters.
+    """
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._values = {name: 0 for name in names}
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+# Registry of metric sources reported by the /metrics route
+_sources = {}
+
+
+def register(name, source):
+    """
+    Registers an object with a snapshot() method under a name.
+    """
+    _sources[name] = source
+    return source
+
+
+def snapshot():
+    return {name: source.snapshot() for name, source in _sources.items()}
@@ -1,3 +1,5 @@
+from datetime import datetime, timezone
+
 from app import db, bcrypt
 from flask_login import UserMixin
 
@@ -14,18 +16,64 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return bcrypt.check_password_hash(self.password, password)
 
+def average_rating(rating_sum, review_count):
+    """
+    Mean review rating to one decimal place, None without reviews.
+    """
+    return round(rating_sum / review_count, 1) if review_count else None
+
+class SessionUser(UserMixin):
+    """
+    What a request needs to know about the logged in user, cached by load_user
+    so requests don't load the whole row. Use User for anything else.
+    """
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+# Primary key covers a movie's genres, the reverse index covers browsing a genre
+movie_genres = db.Table(
+    'movie_genres',
+    db.Column('movie_id', db.Integer, db.ForeignKey('movies.id'), primary_key=True),
+    db.Column('genre_id', db.Integer, db.ForeignKey('genres.id'), primary_key=True),
+    db.Index('ix_movie_genres_genre_id_movie_id', 'genre_id', 'movie_id'),
+)
+
+class Genre(db.Model):
+    __tablename__ = 'genres'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100))
+
 class Movie(db.Model):
     __tablename__ = 'movies'
+    # Most liked first, for the local popular list
+    __table_args__ = (db.Index('ix_movies_like_count_release_date', 'like_count', 'release_date'),)
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
-    genre = db.Column(db.String(100), nullable=False)
     release_date = db.Column(db.Date, nullable=False)
+    genres = db.relationship('Genre', secondary=movie_genres, lazy=True)
     reviews = db.relationship('Review', backref='movie', lazy=True)
     poster_path = db.Column(db.String(300))
     overview = db.Column(db.Text)
+    runtime = db.Column(db.Integer)
+    details = db.Column(db.JSON)  # Cast, director, keywords and trailer, None until enriched
+    # Kept up to date with every like and review, see app.catalog.adjust_aggregates
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    @property
+    def average_rating(self):
+        return average_rating(self.rating_sum, self.review_count)
 
 class Review(db.Model):
     __tablename__ = 'reviews'
+    # A movie's reviews in id order, and a user's reviews
+    __table_args__ = (
+        db.Index('ix_reviews_movie_id_id', 'movie_id', 'id'),
+        db.Index('ix_reviews_user_id', 'user_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False)
@@ -33,8 +81,63 @@ class Review(db.Model):
     review_text = db.Column(db.Text, nullable=True)
 
 class Like(db.Model):
+    # One like per user and movie, also what looks up whether a user liked a movie
+    # The movie index covers counting a movie's likes and finding who liked it
+    __table_args__ = (
+        db.Index('ix_like_user_id_movie_id', 'user_id', 'movie_id', unique=True),
+        db.Index('ix_like_movie_id_user_id', 'movie_id', 'user_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('likes', lazy=True))
-    movie = db.relationship('Movie', backref=db.backref('liked_by', lazy=True))
\ No newline at end of file
+    movie = db.relationship('Movie', backref=db.backref('liked_by', lazy=True))
+
+class SyncState(db.Model):
+    __tablename__ = 'sync_state'
+    key = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.String(200), nullable=False)
+
+class SyncRetry(db.Model):
+    """
+    Movies sync-changes couldn't fetch, tried again on its next run.
+    """
+    __tablename__ = 'sync_retries'
+    movie_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    attempts = db.Column(db.Integer, nullable=False)
+
+class LikeEvent(db.Model):
+    """
+    Outbox of like and unlike changes, written in the same transaction as the
+    like itself and consumed by `flask recommendations-consumer`.
+    """
+    __tablename__ = 'like_events'
+    # AUTOINCREMENT so ids of consumed, deleted events are never handed out again
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    movie_id = db.Column(db.Integer, nullable=False)
+    delta = db.Column(db.SmallInteger, nullable=False)  # 1 for a like, -1 for an unlike
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+
+class MovieAddition(db.Model):
+    """
+    The movies the app stored, in the order it stored them. Workers read the
+    rows past the last one they saw to add those movies to their content index.
+    """
+    __tablename__ = 'movie_additions'
+    # AUTOINCREMENT so ids of pruned rows are never handed out again
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)
+    movie_id = db.Column(db.Integer, nullable=False)
+
+class ItemNeighbour(db.Model):
+    """
+    Neighbour lists updated since the last full build. A movie's rows here
+    replace its row in the build, a row pointing at itself marks an emptied list.
+    """
+    __tablename__ = 'item_neighbours'
+    __table_args__ = (db.Index('ix_item_neighbours_neighbour_id', 'neighbour_id'),)
+    movie_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    neighbour_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    score = db.Column(db.Float, nullable=False)
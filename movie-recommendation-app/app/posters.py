@@ -0,0 +1,229 @@
+import hashlib
+import os
+import re
+import threading
+import time
+
+import requests
+from flask import url_for
+from requests.adapters import HTTPAdapter
+
+from app import app
+from app.metrics import Counter, register
+from app.singleflight import SingleFlight
+
+# Poster renditions TMDb serves, see https://developer.themoviedb.org/docs/image-basics.
+# Only the ones the templates ask for are proxied
+SRCSET_SIZES = ('w185', 'w342', 'w500', 'w780')
+POSTER_PATH = re.compile(r'^[A-Za-z0-9_-]+\.(jpg|jpeg|png|webp)$')
+MIMETYPES = {'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp'}
+# What an index file holds for a poster TMDb doesn't have
+NOT_FOUND = 'not found'
+# Hits refresh an image's mtime, which eviction goes by, at most this often
+TOUCH_INTERVAL = 3600
+# Eviction brings the cache down to this fraction of its limit
+EVICT_TO = 0.9
+
+
+class PosterNotFound(Exception):
+    """
+    Raised when TMDb has no poster for a path and size.
+    """
+
+
+class PosterCache:
+    """
+    On-disk poster cache. Each image is downloaded from TMDb once per size and
+    stored under the SHA-256 of its content; a small index file per (size, path)
+    points at it. The digest doubles as the ETag. Paths TMDb has no poster for
+    are remembered for not_found_ttl seconds.
+
+    Once more than max_bytes of images are stored, the least recently used
+    are deleted in the background.
+    """
+
+    def __init__(self, cache_dir, base_url, max_bytes, not_found_ttl=86400, pool_size=10, timeout=(3.05, 10)):
+        self.cache_dir = cache_dir
+        self.base_url = base_url.rstrip('/')
+        self.max_bytes = max_bytes
+        self.not_found_ttl = not_found_ttl
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.stats = Counter('hits', 'misses', 'not_found', 'evicted')
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        # Bytes this process stored since the cache was last measured, None until it has been
+        self._written = None
+        self._evicting = False
+
+    @property
+    def session(self):
+        """
+        Created lazily and again after a fork, like TMDbClient.session.
+        """
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    session = requests.Session()
+                    session.mount('https://', HTTPAdapter(pool_maxsize=self.pool_size))
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def _index_path(self, size, filename):
+        return os.path.join(self.cache_dir, 'index', size, filename + '.sha256')
+
+    def object_path(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    def _write(self, path, data, mode='wb'):
+        # Write then rename, so readers never see a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, mode) as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, size, filename):
+        """
+        Returns the digest of a poster, downloading it first if it isn't cached.
+        """
+        index_path = self._index_path(size, filename)
+        try:
+            with open(index_path) as index_file:
+                digest = index_file.read().strip()
+            if digest == NOT_FOUND:
+                if time.time() - os.stat(index_path).st_mtime < self.not_found_ttl:
+                    self.stats.inc('not_found')
+                    raise PosterNotFound(f'{size}/{filename}')
+            else:
+                object_stat = os.stat(self.object_path(digest))
+                if time.time() - object_stat.st_mtime > TOUCH_INTERVAL:
+                    os.utime(self.object_path(digest))
+                self.stats.inc('hits')
+                return digest
+        except OSError:
+            pass
+
+        self.stats.inc('misses')
+        return self._flight.do((size, filename), lambda: self._download(size, filename))
+
+    def _download(self, size, filename):
+        response = self.session.get(f'{self.base_url}/{size}/{filename}', timeout=self.timeout)
+        if response.status_code == 404:
+            self.stats.inc('not_found')
+            self._write(self._index_path(size, filename), NOT_FOUND, mode='w')
+            raise PosterNotFound(f'{size}/{filename}')
+        response.raise_for_status()
+
+        digest = hashlib.sha256(response.content).hexdigest()
+        if not os.path.exists(self.object_path(digest)):
+            self._write(self.object_path(digest), response.content)
+            self._stored(len(response.content))
+        self._write(self._index_path(size, filename), digest, mode='w')
+        return digest
+
+    def _stored(self, size):
+        """
+        Starts an eviction pass on the first download of the process and after
+        every tenth of max_bytes stored since.
+        """
+        with self._lock:
+            if self._written is not None:
+                self._written += size
+            if self._evicting or (self._written is not None and self._written < self.max_bytes * (1 - EVICT_TO)):
+                return
+            self._evicting = True
+        threading.Thread(target=self._evict, name='poster-evict', daemon=True).start()
+
+    def _evict(self):
+        """
+        Deletes the least recently used images until the cache is under
+        EVICT_TO of max_bytes, with the index files that point at them.
+        """
+        try:
+            objects = []
+            for directory, _, filenames in os.walk(os.path.join(self.cache_dir, 'objects')):
+                for filename in filenames:
+                    if filename.endswith('.tmp'):
+                        continue
+                    path = os.path.join(directory, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    objects.append((stat.st_mtime, stat.st_size, filename, path))
+            total = sum(size for _, size, _, _ in objects)
+            if total <= self.max_bytes:
+                return
+
+            evicted = set()
+            for _, size, digest, path in sorted(objects):
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted.add(digest)
+            self.stats.inc('evicted', len(evicted))
+
+            for directory, _, filenames in os.walk(os.path.join(self.cache_dir, 'index')):
+                for filename in filenames:
+                    path = os.path.join(directory, filename)
+                    try:
+                        with open(path) as index_file:
+                            if index_file.read().strip() in evicted:
+                                os.remove(path)
+                    except OSError:
+                        continue
+        except Exception:
+            app.logger.exception('Evicting posters failed')
+        finally:
+            with self._lock:
+                self._evicting = False
+                self._written = 0
+
+    def snapshot(self):
+        stats = self.stats.snapshot()
+        stats['evicting'] = self._evicting
+        return stats
+
+
+poster_cache = register('posters', PosterCache(
+    app.config['POSTER_CACHE_DIR'],
+    app.config['TMDB_IMAGE_URL'],
+    max_bytes=app.config['POSTER_CACHE_MAX_BYTES'],
+    not_found_ttl=app.config['POSTER_NOT_FOUND_TTL'],
+))
+
+
+def valid_poster(size, filename):
+    return size in SRCSET_SIZES and POSTER_PATH.match(filename) is not None
+
+
+def mimetype(filename):
+    return MIMETYPES[filename.rsplit('.', 1)[1].lower()]
+
+
+@app.template_global()
+def poster_url(poster_path, size='w342'):
+    """
+    Local URL of a TMDb poster path such as /abc.jpg.
+    """
+    if not poster_path:
+        return ''
+    return url_for('poster', size=size, filename=poster_path.lstrip('/'))
+
+
+@app.template_global()
+def poster_srcset(poster_path):
+    """
+    srcset listing the poster widths the browser can pick from.
+    """
+    if not poster_path:
+        return ''
+    return ', '.join(f'{poster_url(poster_path, size)} {size[1:]}w' for size in SRCSET_SIZES)
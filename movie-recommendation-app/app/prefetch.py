@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from app import app, tmdb
+from app.catalog import popular_cache, popular_key, popular_page
+from app.metrics import Counter, register
+
+# TMDb serves at most this many popular pages
+MAX_POPULAR_PAGE = 500
+
+
+class Prefetcher:
+    """
+    Warms the popular pages after the one a user was just served, so Load More
+    is answered from the cache. Work runs on a small thread pool per process,
+    with a cap on how many pages can be queued or running at once, and pages
+    queued for a user who has since gone idle are dropped before they run.
+    """
+
+    def __init__(self, workers=2, depth=2, max_pending=8, idle_timeout=120):
+        self.workers = workers
+        self.depth = depth
+        self.idle_timeout = idle_timeout
+        self.stats = Counter('scheduled', 'warmed', 'skipped_fresh', 'rejected', 'cancelled', 'errors')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._last_seen = {}
+        self._pending = set()
+        self._executor = None
+        self._pid = None
+
+    @property
+    def executor(self):
+        # Threads don't survive a fork, so each worker process gets its own pool
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='prefetch')
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _is_idle(self, user_id, now):
+        last_seen = self._last_seen.get(user_id)
+        return last_seen is None or now - last_seen > self.idle_timeout
+
+    def page_served(self, user_id, page, language=None):
+        """
+        Records that a user was served a page and schedules the next ones.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._last_seen[user_id] = now
+
+            # Forget users that have gone idle so the map stays small
+            for idle_user in [uid for uid in self._last_seen if self._is_idle(uid, now)]:
+                del self._last_seen[idle_user]
+
+        # Nothing to warm while TMDb calls are being short-circuited
+        if tmdb.client.breaker.state != 'closed':
+            return
+
+        for next_page in range(page + 1, min(page + self.depth, MAX_POPULAR_PAGE) + 1):
+            key = popular_key(next_page, language)
+            if popular_cache.is_fresh(key):
+                self.stats.inc('skipped_fresh')
+                continue
+
+            with self._lock:
+                if key in self._pending:
+                    continue
+                # Global cap, pages beyond it are left for the user's own request
+                if not self._slots.acquire(blocking=False):
+                    self.stats.inc('rejected')
+                    return
+                self._pending.add(key)
+
+            self.stats.inc('scheduled')
+            self.executor.submit(self._warm, user_id, key)
+
+    def _warm(self, user_id, key):
+        try:
+            with self._lock:
+                idle = self._is_idle(user_id, time.monotonic())
+            if idle:
+                self.stats.inc('cancelled')
+                return
+            popular_page(key[1], key[2])
+            self.stats.inc('warmed')
+        except requests.RequestException as error:
+            self.stats.inc('errors')
+            app.logger.warning('Prefetch of %r failed: %s', key, error)
+        except Exception:
+            self.stats.inc('errors')
+            app.logger.exception('Prefetch failed for %r', key)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+            self._slots.release()
+
+    def snapshot(self):
+        stats = self.stats.snapshot()
+        with self._lock:
+            stats['pending'] = len(self._pending)
+            stats['active_users'] = len(self._last_seen)
+        return stats
+
+
+prefetcher = register('prefetch', Prefetcher(
+    workers=app.config['PREFETCH_WORKERS'],
+    depth=app.config['PREFETCH_DEPTH'],
+    max_pending=app.config['PREFETCH_MAX_PENDING'],
+    idle_timeout=app.config['PREFETCH_IDLE_TIMEOUT'],
+))
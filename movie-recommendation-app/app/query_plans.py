@@ -0,0 +1,116 @@
+"""
+The queries the views run on every request, for checking their SQLite query plans.
+
+Each entry builds the statement the same way its view or helper does, with
+placeholder ids. Queries that have to read a whole table give the reason.
+tests/test_query_plans.py checks the statements the routes actually send.
+"""
+import re
+
+from sqlalchemy import select, delete, func
+from sqlalchemy.orm import aliased
+
+from app import db
+from app.models import User, Movie, Review, Like, Genre, movie_genres, LikeEvent, ItemNeighbour, MovieAddition
+
+# The rows of a VALUES list, not a table
+CONSTANT_ROWS = re.compile(r'SCAN (\d+ )?CONSTANT ROWS?$')
+
+
+def hot_queries():
+    """
+    (name, statement, reason a full scan is expected or None) for each hot query.
+    """
+    other_like = aliased(Like)
+    return [
+        ('load_user', select(User.id, User.username).where(User.id == 1), None),
+        ('login / signup / settings username check', select(User).where(User.username == 'name'), None),
+        ('movie by id', select(Movie).where(Movie.id == 1), None),
+        ('like_movie / movie: liked yet', select(Like.id).where(Like.user_id == 1, Like.movie_id == 1), None),
+        ('remove_like', delete(Like).where(Like.user_id == 1, Like.movie_id == 1), None),
+        ('recommendations: liked movie ids', select(Like.movie_id).where(Like.user_id == 1), None),
+        ('recommendations: updated neighbour lists', select(ItemNeighbour).where(ItemNeighbour.movie_id.in_([1, 2])), None),
+        ('consumer: lists holding a movie', select(ItemNeighbour.movie_id).where(ItemNeighbour.neighbour_id == 1), None),
+        ('consumer: next like events', select(LikeEvent.id, LikeEvent.movie_id).where(LikeEvent.id > 10).order_by(LikeEvent.id).limit(1000), None),
+        ('consumer: co-liked movies', (
+            select(other_like.movie_id, func.count(), Movie.like_count)
+            .select_from(Like)
+            .join(other_like, other_like.user_id == Like.user_id)
+            .join(Movie, Movie.id == other_like.movie_id)
+            .where(Like.movie_id == 1, other_like.movie_id != 1)
+            .group_by(other_like.movie_id, Movie.like_count)
+        ), None),
+        ('dashboard liked movies', (
+            select(Movie)
+            .join(Like, Movie.id == Like.movie_id)
+            .where(Like.user_id == 1)
+            .order_by(Movie.release_date.desc())
+        ), None),
+        ("get_reviews: a movie's reviews", (
+            select(Review.id, User.username, Review.rating, Review.review_text)
+            .join(User, User.id == Review.user_id)
+            .where(Review.movie_id == 1, Review.id < 1000)
+            .order_by(Review.id.desc())
+            .limit(20)
+        ), None),
+        ('get_reviews: new reviews since', (
+            select(Review.id, User.username, Review.rating, Review.review_text)
+            .join(User, User.id == Review.user_id)
+            .where(Review.movie_id == 1, Review.id > 1000)
+            .order_by(Review.id.asc())
+            .limit(20)
+        ), None),
+        ("a user's reviews", select(Review).where(Review.user_id == 1), None),
+        ('movie: reviewed yet', select(Review.id).where(Review.user_id == 1, Review.movie_id == 1).limit(1), None),
+        ('train-als: new reviews', select(Review.user_id, Review.movie_id).where(Review.id > 10, Review.id <= 20), None),
+        ("train-als: movies' reviews", (
+            select(Review.id, Review.user_id, Review.movie_id, Review.rating)
+            .where(Review.id <= 20, Review.movie_id.in_([1, 2]))
+        ), None),
+        ("a movie's like count", select(func.count()).select_from(Like).where(Like.movie_id == 1), None),
+        ('genre page', (
+            select(Movie)
+            .join(movie_genres, movie_genres.c.movie_id == Movie.id)
+            .where(movie_genres.c.genre_id == 28)
+            .order_by(movie_genres.c.movie_id.desc())
+            .limit(20)
+        ), None),
+        ('ingest: known movie ids', select(Movie.id).where(Movie.id.in_([1, 2, 3])), None),
+        ('movie: similar or recommended movies', select(Movie).where(Movie.id.in_([1, 2, 3])), None),
+        ('content index: new overviews', select(Movie.id, Movie.overview).where(Movie.id.in_([1, 2, 3])).order_by(Movie.id), None),
+        ('content index: movies stored since', (
+            select(MovieAddition.id, MovieAddition.movie_id)
+            .where(MovieAddition.id > 1)
+            .order_by(MovieAddition.id)
+            .limit(500)
+        ), None),
+        ('local popular movies', (
+            select(Movie)
+            .order_by(Movie.like_count.desc(), Movie.release_date.desc())
+            .limit(20)
+        ), 'walks the like count index from the top, stopping after a page'),
+        ('local search', (
+            select(Movie)
+            .where(Movie.title.ilike('%query%', escape='\\'))
+            .order_by(Movie.release_date.desc())
+            .limit(20)
+        ), 'a substring match cannot use an index, only used while TMDb is down'),
+        ('genre names', select(Genre).where(Genre.name.isnot(None)), 'reads the whole genre list, a few dozen rows'),
+    ]
+
+
+def query_plan(statement):
+    """
+    The detail lines of SQLite's EXPLAIN QUERY PLAN for a statement.
+    """
+    # The placeholder values are inlined, they're all plain ints and strings
+    sql = statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+    rows = db.session.connection().exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}')
+    return [row[3] for row in rows]
+
+
+def full_scans(plan):
+    """
+    Plan lines that read a whole table or index rather than searching it.
+    """
+    return [line for line in plan if line.startswith('SCAN ') and not CONSTANT_ROWS.match(line)]
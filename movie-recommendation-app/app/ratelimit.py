@@ -0,0 +1,120 @@
+import os
+import sqlite3
+import threading
+import time
+
+from app.metrics import Counter, Histogram, LATENCY_BUCKETS
+
+# Interactive calls come from a user waiting on a page, background ones from
+# prefetching, cache refreshes and sync jobs
+PRIORITIES = ('interactive', 'background')
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when no token became free within the caller's allowed wait, or the
+    bucket file stayed locked by other processes.
+    """
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every process on the machine through a small SQLite file.
+
+    The bucket refills at rate tokens per second up to capacity. Background callers
+    may only take a token while more than background_reserve tokens are left, so
+    interactive callers can still get through when background work is busy.
+    """
+
+    def __init__(self, path, rate, capacity, background_reserve=0, max_wait=None, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self.rate = rate
+        self.capacity = capacity
+        self.reserve = {'interactive': 0, 'background': background_reserve}
+        self.max_wait = max_wait or {'interactive': 1.0, 'background': 30.0}
+        self.wait_ms = Histogram((0,) + LATENCY_BUCKETS)
+        self.stats = Counter(*(f'{priority}_{outcome}' for priority in PRIORITIES for outcome in ('acquired', 'rejected')), 'locked')
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads or across a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            # The bucket is throwaway state, durability isn't worth an fsync per call
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket (id INTEGER PRIMARY KEY, tokens REAL, updated REAL)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _try_take(self, priority):
+        """
+        Takes a token if one is free for this priority.
+        Returns 0 on success, otherwise the seconds until one should be.
+        """
+        floor = self.reserve[priority]
+
+        # Past the connection timeout the file is "locked", treated like an empty bucket
+        try:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as error:
+            self.stats.inc('locked')
+            raise RateLimitExceeded(f'TMDb rate limit bucket unavailable: {error}') from error
+        try:
+            # Read the clock once the lock is held, BEGIN may have waited on another process.
+            # Never before the last update, or the time since would be credited twice
+            now = time.time()
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE id = 1').fetchone()
+            tokens, updated = row if row else (self.capacity, now)
+            now = max(now, updated)
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+
+            wait = 0.0
+            if tokens - 1 >= floor:
+                tokens -= 1
+            else:
+                wait = (floor + 1 - tokens) / self.rate
+
+            connection.execute('INSERT OR REPLACE INTO bucket (id, tokens, updated) VALUES (1, ?, ?)', (tokens, now))
+            connection.execute('COMMIT')
+        except sqlite3.OperationalError as error:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            self.stats.inc('locked')
+            raise RateLimitExceeded(f'TMDb rate limit bucket unavailable: {error}') from error
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+    def acquire(self, priority='interactive', max_wait=None):
+        """
+        Blocks until a token is taken, or raises RateLimitExceeded once the
+        wait would go past max_wait seconds (the priority's default if None).
+        """
+        limit = self.max_wait[priority] if max_wait is None else min(max_wait, self.max_wait[priority])
+        start = time.monotonic()
+
+        while True:
+            try:
+                wait = self._try_take(priority)
+            except RateLimitExceeded:
+                self.stats.inc(f'{priority}_rejected')
+                raise
+            waited = time.monotonic() - start
+            if not wait:
+                self.stats.inc(f'{priority}_acquired')
+                self.wait_ms.observe(priority, waited * 1000)
+                return
+            if waited + wait > limit:
+                self.stats.inc(f'{priority}_rejected')
+                self.wait_ms.observe(priority, waited * 1000)
+                raise RateLimitExceeded(f'No TMDb rate limit token free within {limit:.1f}s')
+            time.sleep(wait)
+
+    def snapshot(self):
+        return {'counts': self.stats.snapshot(), 'queue_wait_ms': self.wait_ms.snapshot()}
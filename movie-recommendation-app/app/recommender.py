@@ -0,0 +1,304 @@
+"""
+Item-item collaborative filtering over likes.
+
+Two movies are similar when the same users like both. The similarity is the
+cosine of their like vectors, co_likes / sqrt(likes_a * likes_b), computed for
+every pair with sparse matrix products. Only the top k neighbours of each movie
+are kept, and a user's recommendations are the movies that score highest summed
+over the neighbours of everything they liked.
+"""
+import time
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+
+from app import app, db
+from app.artifacts import ArtifactFile, write_artifact
+from app.metrics import Counter, register
+from app.models import Like
+
+# Similarity rows are computed this many cells at a time, about 128 MB as float32
+BLOCK_CELLS = 32_000_000
+# Above this share of non-zero cells a block is cheaper to rank densely
+DENSE_FRACTION = 0.05
+
+
+def _top_k_dense(block, start, k):
+    """
+    Top k columns of each row of a dense block, best first, -1 where there are fewer.
+    """
+    rows = np.arange(block.shape[0])
+    block[rows, start + rows] = 0  # A movie isn't its own neighbour
+
+    k = min(k, block.shape[1])
+    top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(block, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    top[top_scores <= 0] = -1
+    return top, top_scores
+
+
+def _top_k_sparse(block, start, k):
+    """
+    Same as _top_k_dense for a CSR block, ranking only its stored cells.
+    """
+    neighbours = np.full((block.shape[0], k), -1, dtype=np.int32)
+    scores = np.zeros((block.shape[0], k), dtype=np.float32)
+
+    rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+    keep = (block.indices != start + rows) & (block.data > 0)
+    rows, cols, data = rows[keep], block.indices[keep], block.data[keep]
+
+    # Sort each row's cells by score and keep the first k of every row
+    order = np.lexsort((-data, rows))
+    rows, cols, data = rows[order], cols[order], data[order]
+    row_starts = np.searchsorted(rows, np.arange(block.shape[0]))
+    ranks = np.arange(len(rows)) - row_starts[rows]
+    top = ranks < k
+
+    neighbours[rows[top], ranks[top]] = cols[top]
+    scores[rows[top], ranks[top]] = data[top]
+    return neighbours, scores
+
+
+def build_neighbours(user_ids, movie_ids, k=50, min_support=1, block_cells=BLOCK_CELLS):
+    """
+    Top k most similar movies for every liked movie, from parallel arrays of
+    (user_id, movie_id) likes. Pairs liked together by fewer than min_support
+    users are ignored.
+
+    Returns (movies, neighbours, scores): the sorted movie ids, and for the
+    movie at each index the indices of its neighbours (-1 padded) and their
+    similarities, best first.
+    """
+    movies, movie_index = np.unique(np.asarray(movie_ids), return_inverse=True)
+    _, user_index = np.unique(np.asarray(user_ids), return_inverse=True)
+    n_movies = len(movies)
+
+    # Users x movies, 1 where the user liked the movie
+    likes = sparse.csr_matrix(
+        (np.ones(len(movie_index), dtype=np.float32), (user_index, movie_index)),
+        shape=(user_index.max() + 1 if len(user_index) else 0, n_movies),
+    )
+    likes.sum_duplicates()
+    likes.data[:] = 1
+    by_movie = likes.T.tocsr()
+    norms = np.sqrt(np.asarray(likes.sum(axis=0), dtype=np.float32).ravel())
+
+    neighbours = np.full((n_movies, k), -1, dtype=np.int32)
+    scores = np.zeros((n_movies, k), dtype=np.float32)
+    block_rows = max(1, block_cells // max(n_movies, 1))
+
+    for start in range(0, n_movies, block_rows):
+        end = min(start + block_rows, n_movies)
+
+        # Co-like counts of this block of movies with every movie
+        co_likes = (by_movie[start:end] @ likes).tocsr()
+        if min_support > 1:
+            co_likes.data[co_likes.data < min_support] = 0
+            co_likes.eliminate_zeros()
+
+        # Cosine similarity, scaled in place on the sparse cells
+        rows = np.repeat(np.arange(start, end), np.diff(co_likes.indptr))
+        co_likes.data /= norms[rows] * norms[co_likes.indices]
+
+        if co_likes.nnz > DENSE_FRACTION * (end - start) * n_movies:
+            top, top_scores = _top_k_dense(co_likes.toarray(), start, k)
+        else:
+            top, top_scores = _top_k_sparse(co_likes, start, k)
+        width = top.shape[1]
+        neighbours[start:end, :width] = top
+        scores[start:end, :width] = top_scores
+
+    return movies, neighbours, scores
+
+
+def load_likes():
+    """
+    Every (user_id, movie_id) like as two int64 arrays, read in large batches.
+    """
+    # Straight from the driver cursor, building a Row per like costs more than the query
+    sql = str(select(Like.user_id, Like.movie_id).compile(dialect=db.engine.dialect))
+    batches = []
+    with db.engine.connect() as connection:
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute(sql)
+            while rows := cursor.fetchmany(1_000_000):
+                batches.append(np.array(rows, dtype=np.int64))
+        finally:
+            cursor.close()
+    pairs = np.concatenate(batches) if batches else np.empty((0, 2), dtype=np.int64)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def holder_lists(neighbours):
+    """
+    The reverse of the neighbour lists as CSR (indptr, holders): the rows
+    listing row r as a neighbour are holders[indptr[r]:indptr[r + 1]].
+    """
+    rows = np.repeat(np.arange(len(neighbours), dtype=np.int32), neighbours.shape[1])
+    listed = neighbours.ravel()
+    known = listed >= 0
+    rows, listed = rows[known], listed[known]
+    order = np.argsort(listed, kind='stable')
+    indptr = np.zeros(len(neighbours) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(listed, minlength=len(neighbours)), out=indptr[1:])
+    return indptr, rows[order]
+
+
+def save_neighbours(path, movies, neighbours, scores, min_support=1):
+    """
+    Writes the neighbour lists, who lists each movie, and the min_support
+    they were built with as an artifact, swapped in atomically so running
+    workers never read a half written file.
+    """
+    holders_indptr, holders = holder_lists(neighbours)
+    write_artifact(path, 'neighbours', {
+        'movies': movies.astype(np.int64),
+        'neighbours': neighbours.astype(np.int32),
+        'scores': scores.astype(np.float32),
+        'holders_indptr': holders_indptr,
+        'holders': holders,
+        'min_support': np.array([min_support], dtype=np.int64),
+    })
+
+
+class Recommender:
+    """
+    Serves recommendations from the neighbour lists build-recommendations
+    writes, mapped from the file and remapped when it's replaced.
+    """
+
+    def __init__(self, path):
+        self.file = ArtifactFile(path, 'neighbours')
+        self.stats = Counter('requests', 'no_data')
+        self._holders = (None, None, None)
+
+    def _current(self):
+        artifact = self.file.current()
+        if artifact is None:
+            return None
+        return artifact['movies'], artifact['neighbours'], artifact['scores']
+
+    def _row(self, movies, movie_id):
+        index = np.searchsorted(movies, movie_id)
+        return index if index < len(movies) and movies[index] == movie_id else None
+
+    def neighbours_of(self, movie_id):
+        """
+        A movie's neighbours in the last build, as {movie_id: score}.
+        """
+        data = self._current()
+        if data is None:
+            return {}
+        movies, neighbours, scores = data
+        row = self._row(movies, movie_id)
+        if row is None:
+            return {}
+        known = neighbours[row] >= 0
+        return dict(zip(movies[neighbours[row][known]].tolist(), scores[row][known].tolist()))
+
+    def holders_of(self, movie_id):
+        """
+        Ids of the movies that have movie_id as a neighbour in the last build.
+        """
+        artifact = self.file.current()
+        if artifact is None:
+            return []
+        movies = artifact['movies']
+        row = self._row(movies, movie_id)
+        if row is None:
+            return []
+        if 'holders' in artifact.arrays:
+            indptr, holders = artifact['holders_indptr'], artifact['holders']
+        else:
+            # Written before the reverse lists were stored, derived once per file
+            if self._holders[0] is not artifact:
+                self._holders = (artifact, *holder_lists(artifact['neighbours']))
+            _, indptr, holders = self._holders
+        return movies[holders[indptr[row]:indptr[row + 1]]].tolist()
+
+    def min_support(self):
+        """
+        The co-like count below which the last build dropped a pair.
+        """
+        artifact = self.file.current()
+        if artifact is None or 'min_support' not in artifact.arrays:
+            return 1
+        return int(artifact['min_support'][0])
+
+    def recommend(self, liked_movie_ids, n=20, overrides=None):
+        """
+        Up to n (movie_id, score) pairs for someone who liked liked_movie_ids,
+        best first, leaving out the movies they already liked.
+
+        overrides maps movie ids to newer [(neighbour_id, score)] lists, which
+        are used instead of that movie's row in the last build.
+        """
+        self.stats.inc('requests')
+        overrides = overrides or {}
+        data = self._current()
+        liked = np.asarray(liked_movie_ids, dtype=np.int64)
+        if (data is None and not overrides) or not len(liked):
+            self.stats.inc('no_data')
+            return []
+
+        # Neighbours of the liked movies, from the build unless there's a newer list
+        candidate_ids = [np.array([neighbour for pairs in overrides.values() for neighbour, _ in pairs], dtype=np.int64)]
+        weights = [np.array([score for pairs in overrides.values() for _, score in pairs], dtype=np.float64)]
+        if data is not None and len(data[0]):
+            movies, neighbours, scores = data
+            from_build = liked[~np.isin(liked, list(overrides))]
+            rows = np.searchsorted(movies, from_build)
+            rows = rows[(rows < len(movies)) & (movies[np.minimum(rows, len(movies) - 1)] == from_build)]
+            candidates = neighbours[rows].ravel()
+            known = candidates >= 0
+            candidate_ids.append(movies[candidates[known]])
+            weights.append(scores[rows].ravel()[known])
+        candidate_ids = np.concatenate(candidate_ids)
+        weights = np.concatenate(weights)
+        if not len(candidate_ids):
+            return []
+
+        # Sum each candidate's similarity to everything the user liked
+        unique_ids, positions = np.unique(candidate_ids, return_inverse=True)
+        totals = np.bincount(positions, weights=weights)
+        totals[np.isin(unique_ids, liked)] = 0
+        n = min(n, int(np.count_nonzero(totals > 0)))
+        if not n:
+            return []
+        top = np.argpartition(-totals, n - 1)[:n]
+        top = top[np.argsort(-totals[top], kind='stable')]
+        return [(int(unique_ids[i]), float(totals[i])) for i in top]
+
+    def snapshot(self):
+        stats = self.stats.snapshot()
+        artifact = self.file.current()
+        stats['loads'] = self.file.loads
+        stats['movies'] = len(artifact['movies']) if artifact is not None else 0
+        stats['built_at'] = artifact.version / 1e9 if artifact is not None else None
+        return stats
+
+
+recommender = register('recommender', Recommender(app.config['RECOMMENDATIONS_PATH']))
+
+
+def build_recommendations(k=None, min_support=1, log=print):
+    """
+    Rebuilds the neighbour lists from the like table and saves them.
+    """
+    k = k or app.config['RECOMMENDATIONS_K']
+    started = time.monotonic()
+    user_ids, movie_ids = load_likes()
+    log(f'{len(user_ids):,} likes read in {time.monotonic() - started:.1f}s')
+
+    built = time.monotonic()
+    movies, neighbours, scores = build_neighbours(user_ids, movie_ids, k=k, min_support=min_support)
+    log(f'Neighbours of {len(movies):,} movies built in {time.monotonic() - built:.1f}s')
+
+    save_neighbours(app.config['RECOMMENDATIONS_PATH'], movies, neighbours, scores, min_support)
+    return len(movies)
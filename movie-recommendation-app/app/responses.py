@@ -0,0 +1,69 @@
+import gzip
+import json
+
+from flask import request, Response
+from itsdangerous import URLSafeSerializer, BadSignature
+
+from app import app
+
+# Responses smaller than this aren't worth compressing
+GZIP_MIN_BYTES = 1024
+
+
+def project(record, schema):
+    """
+    Keeps only the fields named in schema. A number in place of None
+    truncates that (string) field to at most that many characters.
+    """
+    projected = {}
+    for field, max_length in schema.items():
+        value = record.get(field) if isinstance(record, dict) else getattr(record, field, None)
+        if max_length is not None and value:
+            value = value[:max_length]
+        projected[field] = value
+    return projected
+
+
+def dumps(data):
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def compress(response):
+    """
+    Gzips a response body when the client accepts it and it's big enough to matter.
+    """
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) >= GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def json_response(data):
+    """
+    Serialises data compactly, see compress() for when it's gzipped.
+    """
+    return compress(Response(dumps(data), mimetype='application/json'))
+
+
+# Cursors are signed so clients can't craft them, but they aren't encrypted
+_cursors = URLSafeSerializer(app.config['SECRET_KEY'], salt='cursor')
+
+
+def encode_cursor(state):
+    """
+    Opaque token for a small dict of paging state.
+    """
+    return _cursors.dumps(state)
+
+
+def decode_cursor(token):
+    """
+    The state in a cursor, or None if it was tampered with or isn't one.
+    """
+    try:
+        state = _cursors.loads(token)
+    except BadSignature:
+        return None
+    return state if isinstance(state, dict) else None
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows, only in-process coalescing is available
+    fcntl = None
+
+from app.metrics import Counter
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key so only the first caller runs them.
+    Other threads asking for the key meanwhile wait and share that caller's result.
+
+    If lock_dir is set, processes are coalesced too: the leader holds an flock on a
+    per-key lock file and leaves its result next to it as JSON, so a process that was
+    waiting on the lock picks the result up instead of repeating the call.
+    """
+
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.stats = Counter('leaders', 'followers', 'shared_across_processes')
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        # Wait for the thread that is already running this call
+        if not leader:
+            self.stats.inc('followers')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        self.stats.inc('leaders')
+        try:
+            if self.lock_dir:
+                call.result = self._run_locked(key, fn)
+            else:
+                call.result = fn()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _run_locked(self, key, fn):
+        """
+        Runs fn while holding the key's lock file, unless another process
+        finished the same call while this one was waiting for the lock.
+        """
+        os.makedirs(self.lock_dir, exist_ok=True)
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        lock_path = os.path.join(self.lock_dir, name + '.lock')
+        result_path = os.path.join(self.lock_dir, name + '.json')
+
+        started = time.time()
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Another process held the lock and wrote a result after we started waiting
+                try:
+                    if os.path.getmtime(result_path) >= started:
+                        with open(result_path) as result_file:
+                            result = json.load(result_file)
+                        self.stats.inc('shared_across_processes')
+                        return result
+                except (OSError, ValueError):
+                    pass
+
+                result = fn()
+
+                # Write the result atomically so readers never see a partial file
+                tmp_path = '%s.%d.tmp' % (result_path, os.getpid())
+                with open(tmp_path, 'w') as result_file:
+                    json.dump(result, result_file)
+                os.replace(tmp_path, result_path)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def snapshot(self):
+        stats = self.stats.snapshot()
+        with self._lock:
+            stats['in_flight'] = len(self._calls)
+        return stats
@@ -1,28 +1,35 @@
 document.addEventListener('DOMContentLoaded', function () {
-    let currentPage = 1;
+    const button = document.getElementById('load-more-button');
+    const moviesContainer = document.getElementById('movies-container');
 
-    document.getElementById('load-more-button').addEventListener('click', function () {
-        currentPage += 1;
+    button.addEventListener('click', function () {
+        // The server hands out the cursor for each next batch
+        const cursor = button.dataset.cursor;
+        button.disabled = true;
 
-        fetch(`/load_more_movies?page=${currentPage}`)
-            .then((response) => response.json())
-            .then((movies) => {
-                const moviesContainer = document.getElementById('movies-container');
-                movies.forEach((movie) => {
-                    const movieCard = `
-                        <div class="col-md-4">
-                            <div class="card mb-4" style="width: 18rem;">
-                                <img src="https://image.tmdb.org/t/p/w500${movie.poster_path}" alt="${movie.title} poster">
-                                <div class="card-body">
-                                    <h2 class="card-title">${movie.title}</h2>
-                                    <p class="card-text">${movie.overview.slice(0, 100)}...</p>
-                                    <a href="/movie/${movie.id}" class="btn bg-secondary">View Details</a>
-                                </div>
-                            </div>
-                        </div>`;
-                    moviesContainer.innerHTML += movieCard; // Append new movie cards
-                });
+        fetch(`/load_more_movies?format=html&cursor=${encodeURIComponent(cursor)}`)
+            .then((response) => {
+                if (!response.ok) {
+                    throw new Error(`HTTP ${response.status}`);
+                }
+                const nextCursor = response.headers.get('X-Next-Cursor');
+                return response.text().then((html) => ({ html, nextCursor }));
             })
-            .catch((error) => console.error('Error loading more movies:', error));
+            .then(({ html, nextCursor }) => {
+                // Parse only the new cards and append them in one go, the existing ones are left alone
+                const cards = document.createRange().createContextualFragment(html);
+                moviesContainer.appendChild(cards);
+
+                if (nextCursor) {
+                    button.dataset.cursor = nextCursor;
+                    button.disabled = false;
+                } else {
+                    button.remove();
+                }
+            })
+            .catch((error) => {
+                console.error('Error loading more movies:', error);
+                button.disabled = false;
+            });
     });
 });
@@ -1,28 +1,48 @@
 $(document).ready(function () {
-    // Get reviews when the page loads
     const movieId = $('#review-form').data('movie-id');
-    fetchReviews(movieId);
+    const reviewsSection = $("#reviews-section");
+    const moreButton = $("#more-reviews");
 
-    function fetchReviews(movieId) {
+    // Newest review shown, for fetching only newer ones, and where the next older page starts
+    let newestId = null;
+    let nextAfter = null;
+
+    // Get the first page when the page loads
+    fetchReviews({}, true);
+
+    function reviewElement(review) {
+        const element = $('<div class="review"></div>');
+        element.append($("<strong></strong>").text(review.username), ` - ${review.rating}/10`);
+        element.append($("<p></p>").text(review.review_text || ""), "<hr>");
+        return element;
+    }
+
+    function fetchReviews(params, append) {
         $.ajax({
             url: `/get_reviews/${movieId}`,
             method: "GET",
-            success: function (reviews) {
-                const reviewsSection = $("#reviews-section");
-                reviewsSection.empty();
-
-                if (reviews.length === 0) {
-                    reviewsSection.append("<p>No reviews yet. Be the first to leave one!</p>");
-                } else {
-                    reviews.forEach((review) => {
-                        reviewsSection.append(`
-                            <div class="review">
-                                <strong>${review.username}</strong> - ${review.rating}/10
-                                <p>${review.review_text}</p>
-                                <hr>
-                            </div>
-                        `);
-                    });
+            data: params,
+            success: function (data) {
+                // Clears the loading or no reviews message
+                if (newestId === null) {
+                    reviewsSection.empty();
+                }
+
+                if (data.reviews.length) {
+                    const elements = data.reviews.map(reviewElement);
+                    if (append) {
+                        reviewsSection.append(elements);
+                    } else {
+                        reviewsSection.prepend(elements);
+                    }
+                    newestId = Math.max(newestId || 0, data.reviews[0].id);
+                } else if (newestId === null) {
+                    reviewsSection.html("<p>No reviews yet. Be the first to leave one!</p>");
+                }
+
+                if (append) {
+                    nextAfter = data.next;
+                    moreButton.toggle(nextAfter !== null);
                 }
             },
             error: function () {
@@ -31,6 +51,11 @@ $(document).ready(function () {
         });
     }
 
+    // Older reviews, a page at a time
+    moreButton.on("click", function () {
+        fetchReviews({ after: nextAfter }, true);
+    });
+
     // Handle review submission
     $("#review-form").on("submit", function (e) {
         e.preventDefault();
@@ -48,7 +73,8 @@ $(document).ready(function () {
             }),
             success: function (response) {
                 alert(response.message);
-                fetchReviews(movieId);
+                // Only fetch what was added since the newest review shown
+                fetchReviews(newestId === null ? {} : { since: newestId }, newestId === null);
                 $("#review-form")[0].reset();
             },
             error: function () {
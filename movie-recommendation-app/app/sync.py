@@ -0,0 +1,148 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import requests
+from sqlalchemy import delete, select, update
+
+from app import app, db
+from app.catalog import movie_row, genre_ids, store_movie_genres
+from app.enrich import fetch_details, detail_columns
+from app.models import Movie, SyncState, SyncRetry
+from app.tmdb import client, TMDbUnavailable
+
+# TMDb only accepts change windows of up to 14 days
+MAX_WINDOW = timedelta(days=14)
+WATERMARK_KEY = 'tmdb_movie_changes'
+# Runs a movie that keeps failing is tried in before it's given up on
+MAX_ATTEMPTS = 5
+
+
+def get_state(key, default=None):
+    state = db.session.get(SyncState, key)
+    return state.value if state else default
+
+
+def set_state(key, value):
+    """
+    Stores a sync value, the caller commits.
+    """
+    db.session.merge(SyncState(key=key, value=value))
+
+
+def changed_ids(start, end):
+    """
+    Yields the ids of every movie TMDb reports as changed between start and end.
+    """
+    page = total_pages = 1
+    while page <= total_pages:
+        data = client.get('/movie/changes', start_date=start.strftime('%Y-%m-%d'),
+                          end_date=end.strftime('%Y-%m-%d'), page=page)
+        total_pages = data.get('total_pages', 1)
+        for change in data.get('results', []):
+            yield change['id']
+        page += 1
+
+
+def fetch_movie(movie_id):
+    """
+    Gets the current details of a movie as a movies table row plus its genre ids,
+    or None if TMDb no longer has it.
+    """
+    movie_data = fetch_details(movie_id)
+    if movie_data is None:
+        return None
+    return {**movie_row(movie_data), **detail_columns(movie_data)}, genre_ids(movie_data)
+
+
+def _try_fetch_movie(movie_id):
+    """
+    fetch_movie, returning the error instead of raising it so one movie can't
+    stop the run. TMDbUnavailable is still raised: an open circuit or an empty
+    rate limit says nothing about the movie, and stops the whole run.
+    """
+    try:
+        return fetch_movie(movie_id), None
+    except TMDbUnavailable:
+        raise
+    except requests.RequestException as error:
+        return None, error
+
+
+def record_failures(failed, checked):
+    """
+    Stores the movies that failed for the next run and forgets the other
+    checked ones. Returns the ids given up on. The caller commits.
+    """
+    attempts = dict(db.session.execute(
+        select(SyncRetry.movie_id, SyncRetry.attempts).where(SyncRetry.movie_id.in_(checked))
+    ).all())
+    db.session.execute(delete(SyncRetry).where(SyncRetry.movie_id.in_(checked)))
+
+    retries = [{'movie_id': movie_id, 'attempts': attempts.get(movie_id, 0) + 1} for movie_id in failed]
+    given_up = [retry['movie_id'] for retry in retries if retry['attempts'] >= MAX_ATTEMPTS]
+    retries = [retry for retry in retries if retry['attempts'] < MAX_ATTEMPTS]
+    if retries:
+        db.session.execute(SyncRetry.__table__.insert(), retries)
+    return given_up
+
+
+def sync_changes(workers=8, batch_size=500, log=print):
+    """
+    Refreshes the movies that changed on TMDb since the last run, and the
+    ones the last runs failed to fetch. Only movies already in the table are
+    fetched again. Returns the number updated and the number that failed,
+    which are tried again next run.
+
+    Raises TMDbUnavailable if TMDb can't be called at all. Chunks already
+    committed stay, but the watermark doesn't move and no movie is charged
+    an attempt, so the next run covers the same window.
+    """
+    end = datetime.now(timezone.utc)
+    watermark = get_state(WATERMARK_KEY)
+    start = datetime.fromisoformat(watermark) if watermark else end - timedelta(days=1)
+    if end - start > MAX_WINDOW:
+        log(f'Last sync was at {start:%Y-%m-%d}, only the last 14 days can be synced')
+        start = end - MAX_WINDOW
+
+    retry_ids = list(db.session.scalars(select(SyncRetry.movie_id)))
+    ids = list(dict.fromkeys([*retry_ids, *changed_ids(start, end)]))
+    log(f'{len(ids) - len(retry_ids):,} movies changed since {start:%Y-%m-%d %H:%M}, {len(retry_ids):,} to retry')
+
+    updated = failed = 0
+    with ThreadPoolExecutor(workers) as executor:
+        try:
+            for i in range(0, len(ids), batch_size):
+                # Only refresh the movies we store
+                chunk = ids[i:i + batch_size]
+                known = list(db.session.scalars(select(Movie.id).where(Movie.id.in_(chunk))))
+
+                fetched, chunk_failed = [], []
+                for movie_id, (movie, error) in zip(known, executor.map(_try_fetch_movie, known)):
+                    if error is not None:
+                        chunk_failed.append(movie_id)
+                        app.logger.warning('Syncing movie %s failed: %s', movie_id, error)
+                    elif movie is not None:
+                        fetched.append(movie)
+
+                rows = [row for row, _ in fetched]
+                if rows:
+                    db.session.execute(update(Movie), rows)
+                    store_movie_genres({row['id']: ids for row, ids in fetched}, replace=True)
+                given_up = record_failures(chunk_failed, chunk)
+                db.session.commit()
+                if given_up:
+                    log(f'Gave up on {len(given_up):,} movies after {MAX_ATTEMPTS} failed runs: {given_up}')
+
+                updated += len(rows)
+                failed += len(chunk_failed)
+                log(f'{min(i + batch_size, len(ids)):,}/{len(ids):,} checked, {updated:,} updated, {failed:,} failed')
+        except TMDbUnavailable:
+            # Drop the rest of this chunk, its movies are fetched again next run
+            executor.shutdown(cancel_futures=True)
+            db.session.rollback()
+            raise
+
+    # The window is done once every movie in it was applied or recorded for a retry
+    set_state(WATERMARK_KEY, end.isoformat())
+    db.session.commit()
+    return updated, failed
@@ -0,0 +1,269 @@
+import os
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from flask import has_request_context
+
+from app import app
+from app.metrics import Histogram, Counter, register
+from app.ratelimit import TokenBucket, RateLimitExceeded
+
+load_dotenv()
+
+# Use of TMDb API to get movie data found at: https://developer.themoviedb.org/docs/getting-started
+KEY = os.getenv("KEY")
+
+# Status codes worth retrying, anything else is returned to the caller straight away
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+latency = register('tmdb_latency_ms', Histogram())
+calls = register('tmdb_calls', Counter('requests', 'retries', 'errors', 'deadline_exceeded', 'short_circuited'))
+
+
+class TMDbUnavailable(requests.RequestException):
+    """
+    Raised instead of calling TMDb when the circuit is open or the call ran out of time.
+    """
+
+
+class TMDbRateLimited(TMDbUnavailable):
+    """
+    Raised when the shared rate limit had no token free in time, TMDb itself was never called.
+    """
+
+
+def _endpoint(path):
+    """
+    Turns a request path into a metric label, e.g. /movie/550 -> /movie/{id}.
+    """
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+
+class CircuitBreaker:
+    """
+    Stops calls to an upstream that keeps failing. After failure_threshold failures
+    in a row the circuit opens and calls fail straight away. Once reset_timeout has
+    passed a single trial call is let through, its result closes or re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.stats = Counter('opened')
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                return True
+            # Open, or half-open with the trial call still running
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self._failures = 0
+
+    def record_skipped(self):
+        """
+        The call was let through but never reached TMDb. If it was the trial
+        call, the next one gets to be the trial instead.
+        """
+        with self._lock:
+            if self.state == 'half_open':
+                self.state = 'open'
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == 'half_open' or self._failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.stats.inc('opened')
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+    def snapshot(self):
+        stats = self.stats.snapshot()
+        with self._lock:
+            stats['state'] = self.state
+            stats['consecutive_failures'] = self._failures
+        return stats
+
+
+class TMDbClient:
+    """
+    Pooled, keep-alive TMDb client shared by every route in a worker process.
+    """
+
+    def __init__(self, base_url, api_key, pool_size=10, connect_timeout=3.05,
+                 read_timeout=10, retries=3, backoff=0.5, deadline=5, breaker=None, limiter=None):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config['TMDB_URL'],
+            KEY,
+            pool_size=config['TMDB_POOL_SIZE'],
+            connect_timeout=config['TMDB_CONNECT_TIMEOUT'],
+            read_timeout=config['TMDB_READ_TIMEOUT'],
+            retries=config['TMDB_RETRIES'],
+            backoff=config['TMDB_BACKOFF'],
+            deadline=config['TMDB_DEADLINE'],
+            breaker=CircuitBreaker(config['TMDB_BREAKER_THRESHOLD'], config['TMDB_BREAKER_RESET']),
+            limiter=TokenBucket(
+                config['TMDB_RATELIMIT_DB'],
+                config['TMDB_RATE'],
+                config['TMDB_BURST'],
+                background_reserve=config['TMDB_BACKGROUND_RESERVE'],
+            ) if config['TMDB_RATELIMIT_DB'] else None,
+        )
+
+    @property
+    def session(self):
+        """
+        The session is created lazily and again after a fork, so pre-forking
+        servers never share sockets between worker processes.
+        """
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def get(self, path, deadline=None, priority=None, **params):
+        """
+        Sends a GET request to the API and returns the decoded JSON body.
+        Connection errors and retryable statuses are retried with exponential backoff,
+        as long as the whole call fits in deadline seconds (TMDB_DEADLINE by default).
+
+        Calls made while handling a request are interactive, anything else
+        (prefetching, cache refreshes, CLI jobs) is background work unless
+        priority says otherwise.
+        """
+        if priority is None:
+            priority = 'interactive' if has_request_context() else 'background'
+
+        if not self.breaker.allow():
+            calls.inc('short_circuited')
+            raise TMDbUnavailable(f'TMDb circuit is open, not calling {path}')
+
+        try:
+            result = self._get(path, deadline or self.deadline, priority, params)
+        except TMDbRateLimited:
+            self.breaker.record_skipped()
+            raise
+        except requests.HTTPError as error:
+            # Client errors such as a 404 mean TMDb is up and answering
+            if error.response is None or error.response.status_code in RETRY_STATUSES:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def _get(self, path, deadline, priority, params):
+        params['api_key'] = self.api_key
+        url = self.base_url + path
+        label = _endpoint(path)
+        deadline_at = time.monotonic() + deadline
+
+        attempt = 0
+        while True:
+            # Never wait on the network past the deadline
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                calls.inc('deadline_exceeded')
+                raise TMDbUnavailable(f'TMDb call to {path} ran out of time')
+            # Wait for the shared rate limit, but not past the deadline either
+            if self.limiter is not None:
+                try:
+                    self.limiter.acquire(priority, max_wait=remaining)
+                except RateLimitExceeded as error:
+                    raise TMDbRateLimited(str(error)) from error
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    calls.inc('deadline_exceeded')
+                    raise TMDbUnavailable(f'TMDb call to {path} ran out of time')
+            timeout = (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+            calls.inc('requests')
+            response = None
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                latency.observe(label, (time.perf_counter() - start) * 1000)
+                if attempt >= self.retries:
+                    calls.inc('errors')
+                    raise
+            else:
+                latency.observe(label, (time.perf_counter() - start) * 1000)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    if not response.ok:
+                        calls.inc('errors')
+                    response.raise_for_status()
+                    return response.json()
+
+            # Back off before the next attempt, honouring Retry-After on 429s
+            delay = self.backoff * (2 ** attempt)
+            if response is not None and response.headers.get('Retry-After', '').isdigit():
+                delay = max(delay, int(response.headers['Retry-After']))
+            if time.monotonic() + delay >= deadline_at:
+                calls.inc('deadline_exceeded')
+                raise TMDbUnavailable(f'TMDb call to {path} ran out of time')
+            attempt += 1
+            calls.inc('retries')
+            time.sleep(delay)
+
+
+client = TMDbClient.from_config(app.config)
+register('tmdb_breaker', client.breaker)
+if client.limiter is not None:
+    register('tmdb_ratelimit', client.limiter)
+
+
+def popular_movies(page=1, language=None):
+    """
+    Gets a page of popular movies.
+    """
+    language = language or app.config['TMDB_LANGUAGE']
+    return client.get('/movie/popular', page=page, language=language).get('results', [])
+
+
+def search_movies(query):
+    """
+    Searches movies by title.
+    """
+    return client.get('/search/movie', query=query).get('results', [])
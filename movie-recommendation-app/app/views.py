@@ -1,16 +1,22 @@
-from flask import render_template, redirect, url_for, flash, request, jsonify
+from flask import render_template, redirect, url_for, flash, request, jsonify, abort, send_file, make_response
 from flask_login import login_user, logout_user, login_required, current_user
 from app.models import User, Movie, Review, Like
 from app.forms import loginForm, signupForm, likeForm, reviewForm
+from app.catalog import insert_ignore, adjust_aggregates, with_aggregates, ingest_movies, popular_page, local_popular_movies, local_search, movie_dict, genre_names, movies_in_genre, movies_in_order, CARD_SCHEMA
+from app.responses import json_response, project, compress, encode_cursor, decode_cursor
+from app.prefetch import prefetcher
+from app.enrich import enricher
+from app.recommender import recommender
+from app.like_events import record_like_event, overlay_lists
+from app.als import rating_predictor
+from app.content import content_index
+from app.posters import poster_cache, valid_poster, mimetype, PosterNotFound
 import requests
-from app import app, db
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from app import app, db, tmdb, metrics, user_cache
 from flask_bcrypt import Bcrypt
-from datetime import datetime
 from flask_restful import Resource, Api
-from dotenv import load_dotenv
-import os
-
-load_dotenv()
 
 bcrypt = Bcrypt(app)
 
@@ -25,8 +31,8 @@ def signup():
     if form.validate_on_submit():
         print("Validate and submit")
 
-        # Check if the username already exists - use of ilike so it's case insensitive
-        existing_user = User.query.filter(User.username.ilike(form.username.data)).first()
+        # Check if the username already exists - usernames are stored lowercase, so this is case insensitive
+        existing_user = User.query.filter_by(username=form.username.data.lower()).first()
         if existing_user:
             flash('Username already exists. Please choose a different one.', 'danger')
             return redirect(url_for('signup'))
@@ -84,10 +90,6 @@ def logout():
     return redirect(url_for('login'))
 
 
-# Use of TMDb API to get movie data found at: https://developer.themoviedb.org/docs/getting-started
-KEY = os.getenv("KEY")
-URL = 'https://api.themoviedb.org/3'
-
 @app.route('/homepage')
 @login_required
 def homepage():
@@ -95,62 +97,57 @@ def homepage():
     Displays movies for the user to see.
     """
     
-    # Getting the data from the API site
-    url = f'{URL}/movie/popular?api_key={KEY}'
-    response = requests.get(url)
-    data = response.json()
-    movies = data.get('results', [])
-    
-    # Going through each movie and storing the relevant data for like/reviewing purposes
-    for movie_data in movies:
-        existing_movie = Movie.query.filter_by(id=movie_data['id']).first()
-        if not existing_movie:
-            release_date = datetime.strptime(movie_data['release_date'], "%Y-%m-%d").date()
-
-            new_movie = Movie(
-                id=movie_data['id'],
-                title=movie_data['title'],
-                genre=', '.join(str(genre_id) for genre_id in movie_data.get('genre_ids', [])),
-                release_date=release_date,
-                poster_path=movie_data.get('poster_path'),
-                overview=movie_data['overview']
-            )
-            db.session.add(new_movie)
-    db.session.commit()
+    # Getting the data from the API site, new movies are stored for like/reviewing purposes
+    try:
+        movies = popular_page()
+    except requests.RequestException:
+        # TMDb is down or too slow, show what we already have instead
+        movies = [movie_dict(movie) for movie in local_popular_movies()]
+        flash('Showing saved movies while TMDb is unavailable.', 'info')
+    else:
+        movies = with_aggregates(movies)
+        # Warm the next pages for the Load More button
+        prefetcher.page_served(current_user.id, 1)
 
-    return render_template('homepage.html', movies=movies)
+    return render_template('homepage.html', movies=movies, next_cursor=encode_cursor({'page': 2}))
 
 @app.route('/load_more_movies', methods=['GET'])
 @login_required
 def load_more_movies():
     """
     Loads more movies when the button is pressed.
+
+    With format=html the cards come back rendered, with the cursor for the
+    next batch in the X-Next-Cursor header. Otherwise they're sent as JSON.
     """
+    # The cursor from the previous batch, or a plain page number
+    cursor = request.args.get('cursor')
+    if cursor:
+        state = decode_cursor(cursor)
+        if state is None or not isinstance(state.get('page'), int):
+            abort(400)
+        page = state['page']
+    else:
+        page = request.args.get('page', 1, type=int)
+
     # Requesting data with the API
-    page = request.args.get('page', 1, type=int)
-    url = f'{URL}/movie/popular?api_key={KEY}&page={page}'
-    response = requests.get(url)
-    data = response.json()
-    movies = data.get('results', [])
-
-    # Storing movie data
-    for movie_data in movies:
-        existing_movie = Movie.query.filter_by(id=movie_data['id']).first()
-        if not existing_movie:
-            release_date = datetime.strptime(movie_data['release_date'], "%Y-%m-%d").date()
-            new_movie = Movie(
-                id=movie_data['id'],
-                title=movie_data['title'],
-                genre=', '.join(str(genre_id) for genre_id in movie_data.get('genre_ids', [])),
-                release_date=release_date,
-                poster_path=movie_data.get('poster_path'),
-                overview=movie_data['overview']
-            )
-            db.session.add(new_movie)
-    db.session.commit()
+    try:
+        movies = popular_page(page)
+    except requests.RequestException:
+        movies = [movie_dict(movie) for movie in local_popular_movies(page)]
+    else:
+        movies = with_aggregates(movies)
+        prefetcher.page_served(current_user.id, page)
+
+    if request.args.get('format') == 'html':
+        response = make_response(render_template('movie_cards.html', movies=movies))
+        # No cursor once the list runs out, which hides the button
+        if movies:
+            response.headers['X-Next-Cursor'] = encode_cursor({'page': page + 1})
+        return compress(response)
 
-    # Return for AJAX use
-    return jsonify(movies)
+    # Return only what the cards show for AJAX use
+    return json_response([project(movie, CARD_SCHEMA) for movie in movies])
 
 @app.route('/search', methods=['GET'])
 @login_required
@@ -165,42 +162,36 @@ def search():
 
     if query:
         # Fetch results from API
-        tmdb_url = f'{URL}/search/movie?api_key={KEY}&query={query}'
-        response = requests.get(tmdb_url)
-        if response.status_code == 200:
-            api_data = response.json()
-            results = api_data.get('results', [])
-
-            # Add movies to the database
-            for movie_data in results:
-                existing_movie = Movie.query.filter_by(id=movie_data['id']).first()
-                if not existing_movie:
-                    # Handle the release_date if it's empty or invalid - Common error when searching
-                    release_date_str = movie_data.get('release_date', '')
-                    release_date = None
-                    if release_date_str:
-                        try:
-                            release_date = datetime.strptime(release_date_str, "%Y-%m-%d").date()
-                        except ValueError:
-                            release_date = None
-
-                    # Add new movie to the database with a valid release_date
-                    new_movie = Movie(
-                        id=movie_data['id'],
-                        title=movie_data['title'],
-                        genre=', '.join(str(genre_id) for genre_id in movie_data.get('genre_ids', [])),
-                        release_date=release_date or datetime(1900, 1, 1).date(), # Giving a default release date if none found
-                        poster_path=movie_data.get('poster_path'),
-                        overview=movie_data['overview']
-                    )
-                    db.session.add(new_movie)
-            db.session.commit()
-
+        try:
+            results = tmdb.search_movies(query)
+        except requests.RequestException:
+            # Fall back to the movies already stored
+            results = [movie_dict(movie) for movie in local_search(query)]
+            flash('TMDb is unavailable, showing matching saved movies only.', 'info')
         else:
-            flash('Failed to fetch search results from TMDb.', 'danger')
+            # Add movies to the database, their details are fetched in the background
+            new_ids = ingest_movies(results)
+            db.session.commit()
+            content_index.add(new_ids)
+            enricher.submit(new_ids)
+            results = with_aggregates(results)
 
     return render_template('search_results.html', query=query, results=results)
 
+@app.route('/genre/<int:genre_id>', methods=['GET'])
+@login_required
+def genre(genre_id):
+    """
+    Lists the stored movies in a genre.
+    """
+    page = request.args.get('page', 1, type=int)
+    movies = movies_in_genre(genre_id, page)
+    name = genre_names().get(genre_id)
+    if name is None and not movies:
+        abort(404)
+
+    return render_template('genre.html', genre_id=genre_id, name=name or f'Genre {genre_id}', movies=movies, page=page)
+
 @app.route('/like_movie', methods=['POST'])
 @login_required
 def like_movie():
@@ -212,14 +203,25 @@ def like_movie():
     data = request.get_json()
     movie_id = data.get("movie_id")
     movie = Movie.query.get_or_404(movie_id)
-    existing_like = Like.query.filter_by(user_id=current_user.id, movie_id=movie.id).first() # Checks if already liked by user
-    
-    # Adding the like to the database
-    if not existing_like:
-        like = Like(user_id=current_user.id, movie_id=movie.id)
-        db.session.add(like)
-        db.session.commit()
-        print("liked movie")
+
+    # Adding the like to the database, a second like of the same movie is a no-op
+    stmt = insert_ignore(Like, 'user_id', 'movie_id')
+    if stmt is not None and db.engine.dialect.insert_returning:
+        added = db.session.execute(stmt.values(user_id=current_user.id, movie_id=movie.id).returning(Like.id)).first()
+    else:
+        try:
+            db.session.add(Like(user_id=current_user.id, movie_id=movie.id))
+            db.session.flush()
+            added = True
+        except IntegrityError:
+            db.session.rollback()
+            added = False
+
+    # The count changes in the same transaction as the like itself
+    if added:
+        adjust_aggregates(movie.id, likes=1)
+        record_like_event(current_user.id, movie.id, 1)
+    db.session.commit()
 
     return jsonify({"status": "success", "message": f"You liked {movie.title}"})
 
@@ -235,12 +237,18 @@ def remove_like():
     movie_id = data.get("movie_id")
     movie = Movie.query.get_or_404(movie_id)
 
-    existing_like = Like.query.filter_by(user_id=current_user.id, movie_id=movie.id).first()
+    # Remove like from database, RETURNING or the row count tells us whether there was one
+    stmt = delete(Like).where(Like.user_id == current_user.id, Like.movie_id == movie.id)
+    if db.engine.dialect.delete_returning:
+        removed = db.session.execute(stmt.returning(Like.id)).first() is not None
+    else:
+        removed = db.session.execute(stmt).rowcount > 0
+    if removed:
+        adjust_aggregates(movie.id, likes=-1)
+        record_like_event(current_user.id, movie.id, -1)
+    db.session.commit()
 
-    # Remove like from database
-    if existing_like:
-        db.session.delete(existing_like)
-        db.session.commit()
+    if removed:
         return jsonify({"status": "success", "message": f"{movie.title} removed from liked movies"})
     else:
         return jsonify({"status": "error", "message": "Movie not found in your liked list"})
@@ -279,11 +287,12 @@ def settings():
     form = signupForm()
 
     if form.validate_on_submit():
-        user = current_user
+        # The full row, current_user only holds the id and username
+        user = db.session.get(User, current_user.id)
 
         # Check if username already exists
         if form.username.data and form.username.data != user.username:
-            existing_user = User.query.filter(User.username.ilike(form.username.data)).first()
+            existing_user = User.query.filter_by(username=form.username.data.lower()).first()
             if existing_user:
                 flash('Username already exists. Please choose a different one.', 'danger')
                 return redirect(url_for('settings'))
@@ -291,6 +300,7 @@ def settings():
                 # Change username if it doesn't exist
                 user.username = form.username.data.lower()
                 db.session.commit()
+                user_cache.invalidate(user.id)
                 flash('Username updated successfully!', 'success')
 
         # Update password
@@ -298,6 +308,7 @@ def settings():
             hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
             user.password = hashed_password
             db.session.commit()
+            user_cache.invalidate(user.id)
             flash('Password updated successfully!', 'success')
 
     return render_template('settings.html', form=form)
@@ -311,7 +322,19 @@ def movie(movie_id):
 
     # Get relevant data to display
     movie = Movie.query.get_or_404(movie_id)
-    liked_movies = {like.movie_id for like in current_user.likes}
+    if movie.details is None:
+        enricher.submit([movie.id])
+    liked = db.session.scalar(select(Like.id).where(Like.user_id == current_user.id, Like.movie_id == movie.id)) is not None
+
+    # The rating model's guess, unless the user already rated it
+    predicted_rating = rating_predictor.predict(current_user.id, [movie.id]).get(movie.id)
+    if predicted_rating is not None and db.session.scalar(
+            select(Review.id).where(Review.user_id == current_user.id, Review.movie_id == movie.id).limit(1)) is not None:
+        predicted_rating = None
+
+    # Movies with similar overviews, for movies nobody has liked yet as well
+    similar = content_index.more_like_this(movie.id, movie.overview, k=app.config['CONTENT_SHOWN'])
+    similar_movies = movies_in_order([movie_id for movie_id, _ in similar])
     like_form = likeForm()
     review_form = reviewForm()
 
@@ -329,6 +352,7 @@ def movie(movie_id):
             review_text=review_form.review_text.data
         )
         db.session.add(new_review)
+        adjust_aggregates(movie.id, reviews=1, ratings=new_review.rating)
         db.session.commit()
         flash('Your review has been submitted!', 'success')
         return redirect(url_for('movie', movie_id=movie.id))
@@ -338,9 +362,25 @@ def movie(movie_id):
         movie=movie,
         like_form=like_form,
         review_form=review_form,
-        liked_movies=liked_movies
+        liked=liked,
+        predicted_rating=predicted_rating,
+        similar_movies=similar_movies,
+        genre_names=genre_names()
     )
 
+def parse_rating(value):
+    """
+    A whole-number rating from a JSON value, or None. The review form sends
+    it as a string, other clients as a number. Booleans and fractions are refused.
+    """
+    if isinstance(value, str) and value.strip().isdecimal():
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return None
+
 @app.route('/submit_review', methods=['POST'])
 @login_required
 def submit_review():
@@ -351,8 +391,10 @@ def submit_review():
     # Get relevant data for the form
     data = request.get_json()
     movie_id = data.get("movie_id")
-    rating = data.get("rating")
     review_text = data.get("review_text")
+    rating = parse_rating(data.get("rating"))
+    if rating is None or not 1 <= rating <= 10:
+        return jsonify({"status": "error", "message": "Rating must be a whole number from 1 to 10"}), 400
 
     # Validate the movie
     movie = Movie.query.get_or_404(movie_id)
@@ -365,6 +407,7 @@ def submit_review():
         review_text=review_text,
     )
     db.session.add(new_review)
+    adjust_aggregates(movie.id, reviews=1, ratings=rating)
     db.session.commit()
 
     return jsonify({"status": "success", "message": "Review submitted successfully"})
@@ -373,18 +416,94 @@ def submit_review():
 @login_required
 def get_reviews(movie_id):
     """
-    Gets reviews for a specific movie.
+    Gets reviews for a specific movie, newest first, a page at a time.
+
+    ?after=<id> continues with the reviews older than that one and
+    ?since=<id> returns only the ones newer than it. next is the after
+    value for the following page, or None once there are no more.
     """
     
     # Check the review database for movies, then return them as a list
     movie = Movie.query.get_or_404(movie_id)
-    reviews = Review.query.filter_by(movie_id=movie.id).all()
+    limit = request.args.get('limit', app.config['REVIEWS_PAGE_SIZE'], type=int)
+    limit = min(max(limit, 1), app.config['REVIEWS_MAX_PAGE_SIZE'])
+    after = request.args.get('after', type=int)
+    since = request.args.get('since', type=int)
+
+    # One query for the page, usernames joined in rather than loaded per review
+    query = (
+        select(Review.id, User.username, Review.rating, Review.review_text)
+        .join(User, User.id == Review.user_id)
+        .where(Review.movie_id == movie.id)
+        .limit(limit)
+    )
+    if since is not None:
+        # Oldest of the new reviews first, so a burst bigger than limit arrives over several calls without gaps
+        rows = list(db.session.execute(query.where(Review.id > since).order_by(Review.id.asc())))
+        rows.reverse()
+    else:
+        if after is not None:
+            query = query.where(Review.id < after)
+        rows = list(db.session.execute(query.order_by(Review.id.desc())))
+
     review_list = [
         {
-            "username": review.user.username,
-            "rating": review.rating,
-            "review_text": review.review_text,
+            "id": row.id,
+            "username": row.username,
+            "rating": row.rating,
+            "review_text": row.review_text,
         }
-        for review in reviews
+        for row in rows
     ]
-    return jsonify(review_list)
+    next_after = rows[-1].id if since is None and len(rows) == limit else None
+    return json_response({"reviews": review_list, "next": next_after})
+
+@app.route('/recommendations')
+@login_required
+def recommendations():
+    """
+    Movies similar to the ones the user liked.
+    """
+    liked_ids = list(db.session.scalars(select(Like.movie_id).where(Like.user_id == current_user.id)))
+    scored = recommender.recommend(liked_ids, n=app.config['RECOMMENDATIONS_SHOWN'], overrides=overlay_lists(liked_ids))
+
+    movies = movies_in_order([movie_id for movie_id, _ in scored])
+
+    return render_template('recommendations.html', movies=movies, has_likes=bool(liked_ids))
+
+@app.route('/metrics', methods=['GET'])
+@login_required
+def metrics_report():
+    """
+    Reports TMDb latency histograms and other internal counters.
+    """
+    return jsonify(metrics.snapshot())
+
+@app.route('/poster/<size>/<filename>', methods=['GET'])
+@login_required
+def poster(size, filename):
+    """
+    Serves a TMDb poster from the local cache. Poster paths never change content,
+    so responses can be cached forever and revalidated by their content hash.
+    """
+    if not valid_poster(size, filename):
+        abort(404)
+
+    try:
+        digest = poster_cache.get(size, filename)
+    except PosterNotFound:
+        abort(404)
+    except requests.RequestException:
+        abort(502)
+
+    # send_file hands the open file to the server, which can use sendfile()
+    response = send_file(
+        poster_cache.object_path(digest),
+        mimetype=mimetype(filename),
+        etag=digest,
+        conditional=True,
+        max_age=31536000,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
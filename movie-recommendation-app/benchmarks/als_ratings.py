@@ -0,0 +1,101 @@
+"""
+Times ALS training and measures its held out RMSE on synthetic ratings drawn
+from a low rank ground truth, then times a warm start that folds in the newest
+ratings.
+
+    python benchmarks/als_ratings.py --regularization 0.02,0.05,0.1,0.2
+    python benchmarks/als_ratings.py --users 100000 --movies 5000 --ratings 5000000
+
+Ratings are 6 plus the dot product of rank --rank factors plus unit noise,
+rounded and clipped to 1-10, one per (user, movie) pair. 10% are held out.
+Timings include the RMSE pass train_als logs after each iteration.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.als import fold_in, rmse, train_als  # noqa: E402
+
+
+def count(value):
+    return int(float(value))
+
+
+def synthetic_ratings(rng, n_users, n_movies, n_ratings, rank):
+    """
+    Shuffled (user_ids, movie_ids, ratings), with a skew towards popular movies.
+    """
+    user_factors = rng.normal(0, 0.6, (n_users, rank))
+    movie_factors = rng.normal(0, 0.6, (n_movies, rank))
+    popularity = 1 / np.arange(1, n_movies + 1) ** 0.8
+    user_ids = rng.integers(0, n_users, n_ratings)
+    movie_ids = rng.choice(n_movies, n_ratings, p=popularity / popularity.sum())
+
+    # Duplicate pairs are dropped, the app keeps one rating per pair too
+    user_ids, movie_ids = np.unique(np.stack([user_ids, movie_ids], axis=1), axis=0).T
+    order = rng.permutation(len(user_ids))
+    user_ids, movie_ids = user_ids[order], movie_ids[order]
+    dot = np.einsum('ij,ij->i', user_factors[user_ids], movie_factors[movie_ids])
+    ratings = np.clip(np.rint(6 + dot + rng.normal(0, 1, len(user_ids))), 1, 10)
+    return user_ids, movie_ids, ratings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=count, default=20_000)
+    parser.add_argument('--movies', type=count, default=2_000)
+    parser.add_argument('--ratings', type=count, default=1_500_000, help='drawn before duplicates are dropped')
+    parser.add_argument('--rank', type=int, default=8, help='rank of the ground truth')
+    parser.add_argument('--factors', type=int, default=32)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=None, help='one per CPU by default')
+    parser.add_argument('--regularization', default='0.1', help='comma separated values to sweep')
+    parser.add_argument('--warm-fraction', type=float, default=0.005,
+                        help='share of the newest training ratings folded in, 0 to skip')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    user_ids, movie_ids, ratings = synthetic_ratings(rng, args.users, args.movies, args.ratings, args.rank)
+    held_out = len(ratings) // 10
+    test = user_ids[:held_out], movie_ids[:held_out], ratings[:held_out]
+    user_ids, movie_ids, ratings = user_ids[held_out:], movie_ids[held_out:], ratings[held_out:]
+    baseline = np.sqrt(np.mean((test[2] - ratings.mean()) ** 2))
+    print(f'{len(ratings):,} training ratings, {held_out:,} held out, mean baseline RMSE {baseline:.3f}')
+
+    for regularization in [float(value) for value in args.regularization.split(',')]:
+        started = time.perf_counter()
+        model = train_als(user_ids, movie_ids, ratings, factors=args.factors, regularization=regularization,
+                          iterations=args.iterations, workers=args.workers)
+        elapsed = time.perf_counter() - started
+        print(f'Regularization {regularization}: {elapsed:.1f}s, '
+              f'{len(ratings) * args.iterations / elapsed:,.0f} ratings/s, test RMSE {rmse(model, *test):.3f}')
+
+    if not args.warm_fraction:
+        return
+
+    # Warm start with the last regularization, train on the older ratings then fold in the newest ones
+    cut = int(len(ratings) * (1 - args.warm_fraction))
+    started = time.perf_counter()
+    base = train_als(user_ids[:cut], movie_ids[:cut], ratings[:cut], factors=args.factors,
+                     regularization=regularization, iterations=args.iterations, workers=args.workers)
+    full_fit = time.perf_counter() - started
+    new_users, new_movies = np.unique(user_ids[cut:]), np.unique(movie_ids[cut:])
+    touched = np.isin(user_ids, new_users) | np.isin(movie_ids, new_movies)
+
+    started = time.perf_counter()
+    warm = fold_in(base, user_ids[touched], movie_ids[touched], ratings[touched], new_users, new_movies,
+                   regularization=regularization)
+    print(f'Warm start: {len(ratings) - cut:,} new ratings touching {len(new_users):,} users and '
+          f'{len(new_movies):,} movies, {touched.sum():,} ratings refit in {time.perf_counter() - started:.2f}s '
+          f'(full fit {full_fit:.1f}s), test RMSE {rmse(base, *test):.3f} before, {rmse(warm, *test):.3f} after')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Counts the SQL statements each request sends, against a scratch database and
+a local fake TMDb.
+
+    python benchmarks/queries_per_request.py [--catalog-size 10000] [-v]
+
+Counts include the Flask-Login user load. Statements sent by background
+threads, such as the enricher's, are left out.
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The app reads its config on import, so point it at a scratch directory first
+DATA_DIR = tempfile.mkdtemp(prefix='movie-app-bench-')
+os.environ['DATA_DIR'] = DATA_DIR
+sys.path.insert(0, ROOT)
+
+from flask_migrate import upgrade  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from app import app, db, tmdb  # noqa: E402
+from app.enrich import enricher  # noqa: E402
+from app.fake_tmdb import create_fake_tmdb  # noqa: E402
+from app.models import User  # noqa: E402
+from app.prefetch import prefetcher  # noqa: E402
+
+REQUESTS = [
+    ('/load_more_movies, unseen page', '/load_more_movies?page=7'),
+    ('/load_more_movies, seen page', '/load_more_movies?page=7'),
+    ('/search, unseen results', '/search?search=benchmark'),
+    ('/search, seen results', '/search?search=benchmark'),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--catalog-size', type=int, default=10000)
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every statement')
+    args = parser.parse_args()
+    for logger in ('werkzeug', 'alembic'):
+        logging.getLogger(logger).setLevel(logging.WARNING)
+
+    server = make_server('127.0.0.1', 0, create_fake_tmdb(catalog_size=args.catalog_size), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    tmdb.client.base_url = f'http://127.0.0.1:{server.server_port}/3'
+
+    app.config.update(WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+        user = User(username='benchmark', password='not a hash')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        engine = db.engine
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    statements = []
+    thread = threading.get_ident()
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread:
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    for name, path in REQUESTS:
+        statements.clear()
+        response = client.get(path)
+        print(f'{name:32} {response.status_code}  {len(statements)} queries')
+        if args.verbose:
+            for statement in statements:
+                print('   ', ' '.join(statement.split())[:120])
+    event.remove(engine, 'before_cursor_execute', record)
+
+    # Prefetching queues enrichment, so it stops first
+    prefetcher.executor.shutdown(cancel_futures=True)
+    enricher.executor.shutdown(cancel_futures=True)
+    server.shutdown()
+    with app.app_context():
+        db.engine.dispose()
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Times the neighbour list build and recommend() on synthetic likes, with a
+Zipf-like skew so a few movies hold most of them.
+
+    python benchmarks/recommender_scale.py --users 1e6 --likes 5e7 --movies 5e4
+
+Needs about 4 GB of memory at that size. Nothing touches the database.
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.recommender import Recommender, build_neighbours, save_neighbours  # noqa: E402
+
+
+def count(value):
+    return int(float(value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=count, default=100_000)
+    parser.add_argument('--likes', type=count, default=5_000_000)
+    parser.add_argument('--movies', type=count, default=50_000)
+    parser.add_argument('--k', type=int, default=50)
+    parser.add_argument('--min-support', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=2000, help='recommend() calls to time')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    popularity = 1 / (np.arange(args.movies) + 50.0) ** 0.9
+    popularity /= popularity.sum()
+
+    started = time.perf_counter()
+    user_ids = rng.integers(0, args.users, args.likes, dtype=np.int64)
+    movie_ids = rng.choice(args.movies, args.likes, p=popularity).astype(np.int64) + 1000
+    print(f'{args.likes:,} likes generated in {time.perf_counter() - started:.1f}s', flush=True)
+
+    started = time.perf_counter()
+    movies, neighbours, scores = build_neighbours(user_ids, movie_ids, k=args.k, min_support=args.min_support)
+    peak_gb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6
+    print(f'Neighbours of {len(movies):,} movies built in {time.perf_counter() - started:.1f}s, '
+          f'peak RSS {peak_gb:.2f} GB', flush=True)
+
+    with tempfile.TemporaryDirectory(prefix='movie-app-bench-') as scratch:
+        path = os.path.join(scratch, 'recommendations.bin')
+        save_neighbours(path, movies, neighbours, scores, args.min_support)
+        recommender = Recommender(path)
+        recommender.recommend([1000])
+
+        timings = []
+        for _ in range(args.requests):
+            liked = rng.choice(args.movies, rng.integers(1, 200), p=popularity) + 1000
+            started = time.perf_counter()
+            recommender.recommend(liked, 24)
+            timings.append(time.perf_counter() - started)
+
+    timings = np.array(timings) * 1000
+    print(f'recommend() with 1-199 liked movies: p50 {np.percentile(timings, 50):.2f} ms, '
+          f'p99 {np.percentile(timings, 99):.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
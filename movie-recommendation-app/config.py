@@ -1,8 +1,81 @@
 import os
 
 basedir = os.path.abspath(os.path.dirname(__file__))
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
+# The database, caches and model files live here, the tests point it at a scratch directory
+datadir = os.getenv('DATA_DIR', basedir)
+SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(datadir, 'app.db')
 SQLALCHEMY_TRACK_MODIFICATIONS = True    
 
 WTF_CSRF_ENABLED = True
-SECRET_KEY = 'a-very-secret-secret'
\ No newline at end of file
+SECRET_KEY = 'a-very-secret-secret'
+
+# TMDb API client settings
+TMDB_URL = os.getenv('TMDB_URL', 'https://api.themoviedb.org/3')
+TMDB_POOL_SIZE = 10
+TMDB_CONNECT_TIMEOUT = 3.05
+TMDB_READ_TIMEOUT = 10
+TMDB_RETRIES = 3
+TMDB_BACKOFF = 0.5
+TMDB_LANGUAGE = 'en-US'
+
+# Popular pages are fresh for TMDB_CACHE_TTL seconds, then served stale while
+# they are refreshed in the background for up to TMDB_CACHE_STALE_TTL more
+TMDB_CACHE_TTL = 1800
+TMDB_CACHE_STALE_TTL = 86400
+TMDB_GENRE_CACHE_TTL = 86400
+
+# Set to a directory to also coalesce identical TMDb calls across worker processes
+TMDB_SINGLEFLIGHT_DIR = None
+
+# Background warming of the popular pages after the one being served
+PREFETCH_WORKERS = 2
+PREFETCH_DEPTH = 2
+PREFETCH_MAX_PENDING = 8
+PREFETCH_IDLE_TIMEOUT = 120
+
+# Every TMDb call has to finish within TMDB_DEADLINE seconds, retries included.
+# After TMDB_BREAKER_THRESHOLD failures in a row calls stop for TMDB_BREAKER_RESET seconds
+TMDB_DEADLINE = 5
+TMDB_BREAKER_THRESHOLD = 5
+TMDB_BREAKER_RESET = 30
+
+# Outbound TMDb calls from every worker share one token bucket stored in this
+# file, refilled at TMDB_RATE calls per second up to TMDB_BURST. Background work
+# leaves TMDB_BACKGROUND_RESERVE tokens for interactive requests. None disables it
+TMDB_RATELIMIT_DB = os.path.join(datadir, 'tmdb_ratelimit.db')
+TMDB_RATE = 40
+TMDB_BURST = 40
+TMDB_BACKGROUND_RESERVE = 10
+
+# Threads per process fetching cast, keywords and trailers for new movies
+ENRICH_WORKERS = 2
+
+# Posters are proxied through /poster and kept on disk here, the least recently
+# used are deleted past POSTER_CACHE_MAX_BYTES. Missing posters are remembered for a day
+TMDB_IMAGE_URL = 'https://image.tmdb.org/t/p'
+POSTER_CACHE_DIR = os.path.join(datadir, 'poster_cache')
+POSTER_CACHE_MAX_BYTES = 512 * 1024 * 1024
+POSTER_NOT_FOUND_TTL = 86400
+
+# Logged in users cached per process, a username change shows in other workers within the TTL
+USER_CACHE_TTL = 60
+USER_CACHE_SIZE = 10000
+
+# Reviews returned per /get_reviews call, by default and at most
+REVIEWS_PAGE_SIZE = 20
+REVIEWS_MAX_PAGE_SIZE = 100
+
+# Item-item neighbour lists written by `flask build-recommendations`, top K per movie
+RECOMMENDATIONS_PATH = os.path.join(datadir, 'recommendations.bin')
+RECOMMENDATIONS_K = 50
+RECOMMENDATIONS_SHOWN = 24
+
+# Rating model written by `flask train-als`
+ALS_PATH = os.path.join(datadir, 'ratings_model.bin')
+ALS_FACTORS = 32
+ALS_REGULARIZATION = 0.1
+ALS_ITERATIONS = 10
+
+# Overview TF-IDF index written by `flask build-content-index`, built in the background if missing
+CONTENT_INDEX_PATH = os.path.join(datadir, 'content_index.bin')
+CONTENT_SHOWN = 6
@@ -0,0 +1,97 @@
+"""normalise movie genres
+
+Revision ID: 7e93ce35c907
+Revises: b3093b2c0bb6
+Create Date: 2026-10-18 11:02:17.284915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e93ce35c907'
+down_revision = 'b3093b2c0bb6'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+movies = sa.table('movies', sa.column('id', sa.Integer), sa.column('genre', sa.String))
+genres = sa.table('genres', sa.column('id', sa.Integer))
+movie_genres = sa.table('movie_genres', sa.column('movie_id', sa.Integer), sa.column('genre_id', sa.Integer))
+
+
+def upgrade():
+    op.create_table('genres',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('movie_genres',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('genre_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['genre_id'], ['genres.id'], ),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ),
+    sa.PrimaryKeyConstraint('movie_id', 'genre_id')
+    )
+    op.create_index('ix_movie_genres_genre_id_movie_id', 'movie_genres', ['genre_id', 'movie_id'], unique=False)
+
+    # Convert the comma separated genre ids a batch of movies at a time
+    connection = op.get_bind()
+    seen_genres = set()
+    last_id = None
+    while True:
+        query = sa.select(movies.c.id, movies.c.genre).order_by(movies.c.id).limit(BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(movies.c.id > last_id)
+        rows = connection.execute(query).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        pairs = []
+        for movie_id, genre in rows:
+            for genre_id in dict.fromkeys(part.strip() for part in (genre or '').split(',')):
+                if genre_id.isdigit():
+                    pairs.append({'movie_id': movie_id, 'genre_id': int(genre_id)})
+
+        new_genres = {pair['genre_id'] for pair in pairs} - seen_genres
+        if new_genres:
+            connection.execute(genres.insert(), [{'id': genre_id} for genre_id in new_genres])
+            seen_genres |= new_genres
+        if pairs:
+            connection.execute(movie_genres.insert(), pairs)
+
+    with op.batch_alter_table('movies', schema=None) as batch_op:
+        batch_op.drop_column('genre')
+
+
+def downgrade():
+    with op.batch_alter_table('movies', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('genre', sa.String(length=100), nullable=False, server_default=''))
+
+    # Rebuild the comma separated strings from the association table
+    connection = op.get_bind()
+    links = connection.execute(
+        sa.select(movie_genres.c.movie_id, movie_genres.c.genre_id)
+        .order_by(movie_genres.c.movie_id, movie_genres.c.genre_id)
+    )
+    current_id, ids, updates = None, [], []
+    for movie_id, genre_id in links:
+        if movie_id != current_id and ids:
+            updates.append({'b_id': current_id, 'genre': ', '.join(ids)})
+            ids = []
+        current_id = movie_id
+        ids.append(str(genre_id))
+    if ids:
+        updates.append({'b_id': current_id, 'genre': ', '.join(ids)})
+    if updates:
+        connection.execute(
+            movies.update().where(movies.c.id == sa.bindparam('b_id')).values(genre=sa.bindparam('genre')),
+            updates,
+        )
+
+    op.drop_index('ix_movie_genres_genre_id_movie_id', table_name='movie_genres')
+    op.drop_table('movie_genres')
+    op.drop_table('genres')
@@ -0,0 +1,97 @@
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from datetime import date
+
+import pytest
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The app reads its config on import, so the database and model files are
+# pointed at a scratch directory before anything imports it, and TMDb at a
+# port nothing listens on unless a test starts the fake server
+DATA_DIR = tempfile.mkdtemp(prefix='movie-app-tests-')
+os.environ['DATA_DIR'] = DATA_DIR
+os.environ['TMDB_URL'] = 'http://127.0.0.1:9/3'
+sys.path.insert(0, ROOT)
+
+from flask_migrate import upgrade  # noqa: E402
+
+from app import app as flask_app, db, tmdb  # noqa: E402
+from app.enrich import enricher  # noqa: E402
+from app.fake_tmdb import create_fake_tmdb  # noqa: E402
+from app.models import User, Movie  # noqa: E402
+
+_ids = itertools.count(1)
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with flask_app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+    yield flask_app
+    # Drop enrichment still queued, TMDb is gone by now
+    enricher.executor.shutdown(cancel_futures=True)
+    with flask_app.app_context():
+        db.engine.dispose()
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def fake_tmdb(app):
+    """
+    Points the TMDb client at a local fake TMDb server for the whole session.
+    """
+    server = make_server('127.0.0.1', 0, create_fake_tmdb(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = tmdb.client.base_url
+    tmdb.client.base_url = f'http://127.0.0.1:{server.server_port}/3'
+    yield server
+    tmdb.client.base_url = base_url
+    server.shutdown()
+
+
+@pytest.fixture
+def user(app):
+    """
+    A new user, as an id.
+    """
+    with app.app_context():
+        user = User(username=f'test{next(_ids)}', password='not a hash')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+@pytest.fixture
+def movie(app):
+    """
+    A new movie nobody has liked or reviewed, as an id.
+    """
+    with app.app_context():
+        movie = Movie(id=900000 + next(_ids), title='Test Movie', release_date=date(2000, 1, 1),
+                      overview='A test movie about testing.')
+        db.session.add(movie)
+        db.session.commit()
+        return movie.id
+
+
+def login(app, user_id):
+    """
+    A test client logged in as user_id.
+    """
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return client
+
+
+@pytest.fixture
+def client(app, user):
+    return login(app, user)
@@ -0,0 +1,60 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import delete
+
+from app import catalog, db, tmdb
+from app.catalog import genre_names, local_search
+from app.models import Genre, Movie
+
+TITLES = {
+    910001: '100% Wolf',
+    910002: '100 Wolves',
+    910003: 'Wolf_Man',
+    910004: 'Wolf Man',
+    910005: 'Wolf\\Pack',
+    910006: 'Wolf Pack',
+}
+
+
+@pytest.fixture
+def titles(app):
+    with app.app_context():
+        db.session.execute(delete(Movie).where(Movie.id.in_(TITLES)))
+        db.session.add_all(Movie(id=movie_id, title=title, release_date=date(2000, 1, 1))
+                           for movie_id, title in TITLES.items())
+        db.session.commit()
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('100%', {910001}),
+    ('f_m', {910003}),
+    ('f\\p', {910005}),
+    ('WOLF M', {910004}),
+])
+def test_local_search_matches_wildcards_literally(app, titles, query, expected):
+    with app.app_context():
+        found = {movie.id for movie in local_search(query, limit=100)}
+    assert found & set(TITLES) == expected
+
+
+def test_genre_names_per_language(app, monkeypatch):
+    names = {'en-US': 'Action', 'fr-FR': 'Action FR'}
+    monkeypatch.setattr(tmdb.client, 'get', lambda path, language: {'genres': [{'id': 28, 'name': names[language]}]})
+    monkeypatch.setattr(catalog, '_schedule_genre_fetch', lambda language: None)
+    monkeypatch.setattr(catalog, '_genre_translations', {})
+    with app.app_context():
+        db.session.merge(Genre(id=28, name='Old Action'))
+        db.session.commit()
+        catalog.genre_cache.invalidate(('/genre/movie/list', 'en-US'))
+
+        # Cached per language, the first caller's language isn't served to the rest
+        assert genre_names('fr-FR')[28] == 'Old Action'
+        catalog._fetch_genre_names('fr-FR')
+        assert genre_names('fr-FR')[28] == 'Action FR'
+        assert genre_names()[28] == 'Old Action'
+
+        catalog._fetch_genre_names('en-US')
+        assert genre_names()[28] == 'Action'
+        assert genre_names('fr-FR')[28] == 'Action FR'
+        assert db.session.get(Genre, 28).name == 'Action'
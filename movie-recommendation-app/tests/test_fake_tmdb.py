@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+from flask import Flask, Response, jsonify
+from werkzeug.serving import make_server
+
+from app.fake_tmdb import create_fake_tmdb
+
+
+@pytest.fixture(scope='module')
+def upstream():
+    """
+    A stand-in for the real API answering with JSON, an HTML error page and an empty body.
+    """
+    real = Flask('upstream')
+
+    @real.route('/3/movie/popular')
+    def popular():
+        return jsonify({'page': 1, 'results': []})
+
+    @real.route('/3/movie/550')
+    def bad_gateway():
+        return Response('<html><body>502 Bad Gateway</body></html>', status=502, content_type='text/html')
+
+    @real.route('/3/movie/551')
+    def no_content():
+        return Response(status=204)
+
+    server = make_server('127.0.0.1', 0, real, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+def replies(upstream, cassette_dir, path):
+    """
+    The fake's reply to path in record mode, then in replay mode.
+    """
+    for mode in ('record', 'replay'):
+        fake = create_fake_tmdb(mode=mode, cassette_dir=cassette_dir, upstream=upstream)
+        yield fake.test_client().get(path, query_string={'api_key': 'secret'})
+
+
+def test_json_is_recorded(upstream, tmp_path):
+    for response in replies(upstream, str(tmp_path), '/3/movie/popular'):
+        assert response.status_code == 200
+        assert response.get_json() == {'page': 1, 'results': []}
+
+
+def test_non_json_is_recorded_as_it_came(upstream, tmp_path):
+    for response in replies(upstream, str(tmp_path), '/3/movie/550'):
+        assert response.status_code == 502
+        assert response.mimetype == 'text/html'
+        assert response.data == b'<html><body>502 Bad Gateway</body></html>'
+
+    for response in replies(upstream, str(tmp_path), '/3/movie/551'):
+        assert response.status_code == 204
+        assert response.data == b''
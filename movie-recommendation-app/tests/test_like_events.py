@@ -0,0 +1,48 @@
+import threading
+from datetime import date
+
+from sqlalchemy import delete
+
+from app import db
+from app.like_events import apply_like_events, overlay_lists
+from app.models import Movie
+from conftest import login
+
+MOVIES = [910101, 910102]
+
+
+def consume(app):
+    with app.app_context():
+        while apply_like_events()[0]:
+            pass
+
+
+def test_consumer_batch_during_a_build(app, user, monkeypatch):
+    with app.app_context():
+        db.session.execute(delete(Movie).where(Movie.id.in_(MOVIES)))
+        db.session.add_all(Movie(id=movie_id, title='Test Movie', release_date=date(2000, 1, 1)) for movie_id in MOVIES)
+        db.session.commit()
+    consume(app)
+
+    # Likes the build doesn't read, and a consumer batch for them started while it runs
+    client = login(app, user)
+    consumer = threading.Thread(target=consume, args=(app,))
+    from app.recommender import load_likes
+
+    def load_likes_then_like():
+        likes = load_likes()
+        for movie_id in MOVIES:
+            client.post('/like_movie', json={'movie_id': movie_id})
+        consumer.start()
+        consumer.join(0.5)
+        assert consumer.is_alive(), 'the consumer ran during the build'
+        return likes
+
+    monkeypatch.setattr('app.recommender.load_likes', load_likes_then_like)
+    result = app.test_cli_runner().invoke(args=['build-recommendations'])
+    assert result.exit_code == 0, result.output
+    consumer.join(10)
+
+    # The consumer applied them on top of the new build, the reset didn't drop them
+    with app.app_context():
+        assert overlay_lists(MOVIES) == {MOVIES[0]: [(MOVIES[1], 1.0)], MOVIES[1]: [(MOVIES[0], 1.0)]}
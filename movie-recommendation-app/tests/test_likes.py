@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+from sqlalchemy import func, select
+
+from app import db
+from app.models import Like, LikeEvent, Movie
+from conftest import login
+
+
+@pytest.fixture(params=[True, False], ids=['returning', 'no returning'])
+def returning(request, app, monkeypatch):
+    """
+    Runs a test with RETURNING and again as on a database without it.
+    """
+    with app.app_context():
+        dialect = db.engine.dialect
+    monkeypatch.setattr(dialect, 'insert_returning', request.param)
+    monkeypatch.setattr(dialect, 'delete_returning', request.param)
+    return request.param
+
+
+def like_state(app, user, movie):
+    with app.app_context():
+        likes = db.session.scalar(select(func.count()).select_from(Like).where(Like.user_id == user, Like.movie_id == movie))
+        like_count = db.session.get(Movie, movie).like_count
+        events = db.session.scalar(select(func.coalesce(func.sum(LikeEvent.delta), 0)).where(
+            LikeEvent.user_id == user, LikeEvent.movie_id == movie))
+    return likes, like_count, events
+
+
+def run_concurrently(app, user, requests):
+    """
+    Sends (path, movie_id) requests from one thread each, all released at once.
+    Returns the responses' status codes.
+    """
+    barrier = threading.Barrier(len(requests))
+    statuses = [None] * len(requests)
+
+    def send(position, path, movie_id):
+        client = login(app, user)
+        barrier.wait()
+        statuses[position] = client.post(path, json={'movie_id': movie_id}).status_code
+
+    threads = [threading.Thread(target=send, args=(position, *request)) for position, request in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses
+
+
+def test_like_twice_is_one_like(app, client, user, movie, returning):
+    assert client.post('/like_movie', json={'movie_id': movie}).status_code == 200
+    assert client.post('/like_movie', json={'movie_id': movie}).status_code == 200
+    assert like_state(app, user, movie) == (1, 1, 1)
+
+
+def test_remove_like_without_a_like(app, client, user, movie, returning):
+    response = client.post('/remove_like', json={'movie_id': movie})
+    assert response.get_json()['status'] == 'error'
+    assert like_state(app, user, movie) == (0, 0, 0)
+
+
+def test_concurrent_likes(app, user, movie, returning):
+    statuses = run_concurrently(app, user, [('/like_movie', movie)] * 8)
+    assert statuses == [200] * 8
+    assert like_state(app, user, movie) == (1, 1, 1)
+
+
+def test_concurrent_likes_and_unlikes(app, user, movie, returning):
+    login(app, user).post('/like_movie', json={'movie_id': movie})
+    statuses = run_concurrently(app, user, [('/like_movie', movie), ('/remove_like', movie)] * 4 + [('/like_movie', movie)])
+    assert statuses == [200] * 9
+
+    # Whatever order they ran in, the count and the events agree with the rows
+    likes, like_count, events = like_state(app, user, movie)
+    assert likes in (0, 1)
+    assert like_count == likes
+    assert events == likes
+
+    # And the pair is back to a single like after one more
+    login(app, user).post('/like_movie', json={'movie_id': movie})
+    assert like_state(app, user, movie) == (1, 1, 1)
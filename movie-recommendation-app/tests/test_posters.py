@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+import pytest
+from flask import Flask, abort
+from werkzeug.serving import make_server
+
+from app.posters import PosterCache, poster_cache
+from conftest import DATA_DIR
+
+IMAGE = b'\xff\xd8\xff' + b'poster' * 100
+
+
+@pytest.fixture(scope='module')
+def image_server():
+    """
+    Serves every poster but /missing.jpg, counting the requests.
+    """
+    images = Flask('images')
+    images.requests = []
+
+    @images.route('/<size>/<filename>')
+    def image(size, filename):
+        images.requests.append((size, filename))
+        if filename == 'missing.jpg':
+            abort(404)
+        return IMAGE + filename.encode()
+
+    server = make_server('127.0.0.1', 0, images, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield images, f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+@pytest.fixture
+def posters(image_server, monkeypatch):
+    images, base_url = image_server
+    images.requests.clear()
+    monkeypatch.setattr(poster_cache, 'base_url', base_url)
+    return images
+
+
+def test_poster_is_fetched_once(client, posters):
+    first = client.get('/poster/w342/abc.jpg')
+    assert first.status_code == 200
+    assert first.data == IMAGE + b'abc.jpg'
+    assert client.get('/poster/w342/abc.jpg', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    assert posters.requests == [('w342', 'abc.jpg')]
+
+
+def test_only_srcset_sizes(client, posters):
+    assert client.get('/poster/original/abc.jpg').status_code == 404
+    assert client.get('/poster/w92/abc.jpg').status_code == 404
+    assert posters.requests == []
+
+
+def test_login_required(app, posters):
+    assert app.test_client().get('/poster/w342/abc.jpg').status_code == 302
+    assert posters.requests == []
+
+
+def test_missing_poster_is_remembered(client, posters):
+    assert client.get('/poster/w185/missing.jpg').status_code == 404
+    assert client.get('/poster/w185/missing.jpg').status_code == 404
+    assert posters.requests == [('w185', 'missing.jpg')]
+
+
+def test_least_recently_used_posters_are_evicted(image_server):
+    _, base_url = image_server
+    cache = PosterCache(os.path.join(DATA_DIR, 'evicted_posters'), base_url, max_bytes=10 ** 9)
+    digests = [cache.get('w185', f'{number}.jpg') for number in range(10)]
+    while cache.snapshot()['evicting']:
+        time.sleep(0.01)
+
+    # Room for five, the first poster is the most recently used
+    cache.max_bytes = len(IMAGE + b'0.jpg') * 5
+    os.utime(cache.object_path(digests[0]), (0, 2 ** 31))
+    cache._evict()
+    kept = [digest for digest in digests if os.path.exists(cache.object_path(digest))]
+    assert digests[0] in kept
+    assert len(kept) == 4
+    assert cache.snapshot()['evicted'] == 6
+
+    # The index of an evicted poster is gone too, so it's downloaded again
+    evicted = digests[1] if digests[1] not in kept else digests[2]
+    number = digests.index(evicted)
+    assert cache.get('w185', f'{number}.jpg') == evicted
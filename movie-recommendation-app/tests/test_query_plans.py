@@ -0,0 +1,146 @@
+"""
+Drives the routes with the test client, records every statement they send to
+SQLite and fails if one of them reads a whole table it could have searched.
+"""
+import re
+import threading
+from contextlib import contextmanager
+
+import pytest
+import requests
+from sqlalchemy import event, func, select
+
+from app import app as flask_app, db, tmdb
+from app.catalog import popular_cache, popular_key
+from app.models import Movie, Review
+from app.query_plans import full_scans, hot_queries, query_plan
+from app.recommender import build_recommendations
+
+# Full scans a statement may do: (pattern the statement matches, plan line, why)
+EXPECTED_SCANS = [
+    (r'ORDER BY movies\.like_count DESC', 'SCAN movies USING INDEX ix_movies_like_count_release_date',
+     'walks the like count index from the top, stopping after a page'),
+    (r'lower\(movies\.title\) LIKE lower', 'SCAN movies',
+     'a substring match cannot use an index, only used while TMDb is down'),
+    (r'FROM genres', 'SCAN genres', 'reads the whole genre list, a few dozen rows'),
+]
+STATEMENTS = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+
+
+@contextmanager
+def recorded_statements():
+    """
+    Collects the (statement, parameters) pairs this thread sends, leaving
+    out background threads such as the enricher's.
+    """
+    statements = []
+    thread = threading.get_ident()
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread and STATEMENTS.match(statement):
+            # An executemany sends a list of parameter rows, one is enough for the plan
+            if parameters and isinstance(parameters[0], (list, tuple)):
+                parameters = parameters[0]
+            statements.append((statement, tuple(parameters)))
+
+    with flask_app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+def unexpected_scans(statements):
+    """
+    (statement, plan) of each statement with a full scan it isn't expected to do.
+    """
+    failures = []
+    with flask_app.app_context():
+        connection = db.session.connection()
+        for statement, parameters in dict.fromkeys(statements):
+            plan = [row[3] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+            allowed = {line for pattern, line, _ in EXPECTED_SCANS if re.search(pattern, statement)}
+            if set(full_scans(plan)) - allowed:
+                failures.append((statement, plan))
+    return failures
+
+
+@pytest.fixture(scope='module')
+def catalog(app, fake_tmdb):
+    """
+    A user with likes and reviews on movies ingested from the fake TMDb,
+    and a neighbour list build over them.
+    """
+    client = app.test_client()
+    client.post('/signup', data={'username': 'plans', 'password': 'password1'})
+    client.get('/homepage')
+    with app.app_context():
+        movie_ids = list(db.session.scalars(select(Movie.id).order_by(Movie.id).limit(5)))
+    for movie_id in movie_ids[:3]:
+        client.post('/like_movie', json={'movie_id': movie_id})
+        client.post('/submit_review', json={'movie_id': movie_id, 'rating': 7, 'review_text': 'Fine'})
+    with app.app_context():
+        build_recommendations(log=lambda message: None)
+    return client, movie_ids
+
+
+def request_every_route(client, movie_ids):
+    movie_id = movie_ids[0]
+    with flask_app.app_context():
+        newest_review = db.session.scalar(select(func.max(Review.id)).where(Review.movie_id == movie_id))
+
+    client.get('/homepage')
+    client.get('/load_more_movies?page=2')
+    client.get('/load_more_movies?page=2&format=html')
+    client.get('/search?search=star')
+    client.get('/genre/28')
+    client.get(f'/movie/{movie_id}')
+    client.get(f'/movie/{movie_ids[4]}')
+    client.post('/like_movie', json={'movie_id': movie_ids[3]})
+    client.post('/remove_like', json={'movie_id': movie_ids[3]})
+    client.post('/submit_review', json={'movie_id': movie_id, 'rating': 5, 'review_text': 'Again'})
+    client.get(f'/get_reviews/{movie_id}')
+    client.get(f'/get_reviews/{movie_id}?after={newest_review}')
+    client.get(f'/get_reviews/{movie_id}?since={newest_review}')
+    client.get('/dashboard')
+    client.get('/recommendations')
+    client.get('/settings')
+    client.post('/settings', data={'username': 'plans2', 'password': ''})
+    client.get('/metrics')
+
+
+def test_routes_search_their_tables(catalog):
+    client, movie_ids = catalog
+    with recorded_statements() as statements:
+        request_every_route(client, movie_ids)
+    assert statements
+    assert unexpected_scans(statements) == []
+
+
+def test_routes_search_their_tables_while_tmdb_is_down(catalog, monkeypatch):
+    client, movie_ids = catalog
+
+    def unavailable(*args, **kwargs):
+        raise requests.ConnectionError('TMDb is down')
+
+    monkeypatch.setattr(tmdb.client, 'get', unavailable)
+    popular_cache.invalidate(popular_key(1))
+    with recorded_statements() as statements:
+        client.get('/homepage')
+        client.get('/load_more_movies?page=7')
+        client.get('/search?search=nothing+cached')
+
+    # The local fallbacks ran, and only scan what they're expected to
+    sql = '\n'.join(statement for statement, _ in statements)
+    assert 'ORDER BY movies.like_count DESC' in sql
+    assert 'LIKE lower' in sql
+    assert unexpected_scans(statements) == []
+
+
+def test_hot_queries(app):
+    with app.app_context():
+        failures = [name for name, statement, expected_scan in hot_queries()
+                    if full_scans(query_plan(statement)) and not expected_scan]
+    assert failures == []
@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from app import tmdb
+from app.catalog import popular_cache, popular_key
+from app.ratelimit import RateLimitExceeded, TokenBucket
+from conftest import DATA_DIR
+
+
+@pytest.fixture
+def locked_bucket():
+    """
+    A token bucket whose file another process holds an exclusive lock on.
+    """
+    path = os.path.join(DATA_DIR, 'locked_bucket.db')
+    bucket = TokenBucket(path, rate=10, capacity=10, timeout=0.05)
+    bucket.acquire()
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute('BEGIN EXCLUSIVE')
+    yield bucket
+    other.execute('ROLLBACK')
+    other.close()
+
+
+def test_locked_bucket_is_a_rate_limit(locked_bucket):
+    with pytest.raises(RateLimitExceeded):
+        locked_bucket.acquire()
+    counts = locked_bucket.snapshot()['counts']
+    assert counts['locked'] == 1
+    assert counts['interactive_rejected'] == 1
+
+
+def test_homepage_falls_back_when_the_bucket_is_locked(client, locked_bucket, monkeypatch):
+    monkeypatch.setattr(tmdb.client, 'limiter', locked_bucket)
+    popular_cache.invalidate(popular_key(1))
+    response = client.get('/homepage')
+    assert response.status_code == 200
+    assert b'Showing saved movies while TMDb is unavailable.' in response.data
+
+
+def test_refill_is_timed_after_waiting_for_the_lock():
+    path = os.path.join(DATA_DIR, 'contended_bucket.db')
+    bucket = TokenBucket(path, rate=10, capacity=10)
+    bucket.acquire()
+
+    # Another process holds the lock, then empties the bucket as it releases it
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    waiting = threading.Thread(target=bucket._try_take, args=('interactive',))
+    waiting.start()
+    time.sleep(0.3)
+    released_at = time.time()
+    other.execute('UPDATE bucket SET tokens = 1, updated = ?', (released_at,))
+    other.execute('COMMIT')
+    waiting.join()
+
+    # The waiter took the last token, without crediting the 0.3s it spent waiting
+    tokens, updated = other.execute('SELECT tokens, updated FROM bucket').fetchone()
+    other.close()
+    assert updated >= released_at
+    assert tokens < 1
+
+
+def test_clock_going_back_credits_nothing(monkeypatch):
+    path = os.path.join(DATA_DIR, 'clock_bucket.db')
+    bucket = TokenBucket(path, rate=10, capacity=10)
+    bucket.acquire()
+    updated = bucket._connection().execute('SELECT updated FROM bucket').fetchone()[0]
+
+    monkeypatch.setattr(time, 'time', lambda: updated - 60)
+    bucket.acquire()
+    assert bucket._connection().execute('SELECT updated FROM bucket').fetchone()[0] == updated
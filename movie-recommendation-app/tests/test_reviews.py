@@ -0,0 +1,23 @@
+import pytest
+from sqlalchemy import select
+
+from app import db
+from app.models import Movie, Review
+
+
+@pytest.mark.parametrize('rating', [7.9, True, None, '7.5', 'seven', 0, 11, [7]])
+def test_bad_ratings_are_refused(app, client, movie, rating):
+    response = client.post('/submit_review', json={'movie_id': movie, 'rating': rating, 'review_text': 'Hmm'})
+    assert response.status_code == 400
+    with app.app_context():
+        assert db.session.scalar(select(Review.id).where(Review.movie_id == movie)) is None
+        assert db.session.get(Movie, movie).review_count == 0
+
+
+@pytest.mark.parametrize('rating', [7, '7', 7.0])
+def test_whole_ratings_are_stored(app, client, movie, rating):
+    response = client.post('/submit_review', json={'movie_id': movie, 'rating': rating, 'review_text': 'Good'})
+    assert response.status_code == 200
+    with app.app_context():
+        assert db.session.scalars(select(Review.rating).where(Review.movie_id == movie)).all() == [7]
+        assert db.session.get(Movie, movie).rating_sum == 7
@@ -0,0 +1,97 @@
+from datetime import date
+
+import pytest
+import requests
+from sqlalchemy import delete, select
+
+from app import db, sync
+from app.models import Movie, SyncRetry
+from app.tmdb import TMDbRateLimited, TMDbUnavailable
+
+
+def quiet(message):
+    pass
+
+
+@pytest.fixture
+def stored(app, fake_tmdb):
+    """
+    Four stored movies from the fake TMDb catalog with stale titles, reported as changed.
+    """
+    ids = [5001, 5002, 5003, 5004]
+    with app.app_context():
+        db.session.execute(delete(SyncRetry))
+        db.session.execute(delete(Movie).where(Movie.id.in_(ids)))
+        db.session.add_all(Movie(id=movie_id, title='Stale', release_date=date(2000, 1, 1)) for movie_id in ids)
+        db.session.commit()
+    return ids
+
+
+@pytest.fixture
+def broken(monkeypatch, stored):
+    """
+    Ids whose detail requests fail, and the changes feed reporting the stored movies.
+    """
+    broken = {}
+    fetch_details = sync.fetch_details
+
+    def flaky(movie_id):
+        if movie_id in broken:
+            raise broken[movie_id]
+        return fetch_details(movie_id)
+
+    monkeypatch.setattr(sync, 'fetch_details', flaky)
+    monkeypatch.setattr(sync, 'changed_ids', lambda start, end: iter(stored))
+    return broken
+
+
+def stale_and_retried(ids):
+    stale = set(db.session.scalars(select(Movie.id).where(Movie.id.in_(ids), Movie.title == 'Stale')))
+    retries = dict(db.session.execute(select(SyncRetry.movie_id, SyncRetry.attempts)).all())
+    return stale, retries
+
+
+def test_failed_movies_are_retried_next_run(app, stored, broken, monkeypatch):
+    broken.update(dict.fromkeys(stored[1:3], requests.ConnectionError('Connection reset by peer')))
+    with app.app_context():
+        assert sync.sync_changes(log=quiet) == (2, 2)
+        assert stale_and_retried(stored) == (set(stored[1:3]), {stored[1]: 1, stored[2]: 1})
+        first_watermark = sync.get_state(sync.WATERMARK_KEY)
+        assert first_watermark is not None
+
+    # TMDb is back and nothing else changed, the failed movies are fetched anyway
+    broken.clear()
+    monkeypatch.setattr(sync, 'changed_ids', lambda start, end: iter([]))
+    with app.app_context():
+        assert sync.sync_changes(log=quiet) == (2, 0)
+        assert stale_and_retried(stored) == (set(), {})
+        assert sync.get_state(sync.WATERMARK_KEY) > first_watermark
+
+
+def test_movies_are_given_up_on(app, stored, broken, monkeypatch):
+    monkeypatch.setattr(sync, 'MAX_ATTEMPTS', 2)
+    broken[stored[0]] = requests.HTTPError('502 Server Error: Bad Gateway')
+    with app.app_context():
+        assert sync.sync_changes(log=quiet) == (3, 1)
+        assert stale_and_retried(stored)[1] == {stored[0]: 1}
+        assert sync.sync_changes(log=quiet) == (3, 1)
+        assert stale_and_retried(stored) == ({stored[0]}, {})
+
+
+@pytest.mark.parametrize('error', [
+    TMDbUnavailable('TMDb circuit is open, not calling /movie/5003'),
+    TMDbRateLimited('No background token within 5.0s'),
+])
+def test_tmdb_unavailable_stops_the_run(app, stored, broken, error):
+    broken[stored[0]] = requests.ConnectionError('Connection reset by peer')
+    with app.app_context():
+        assert sync.sync_changes(log=quiet) == (3, 1)
+        watermark = sync.get_state(sync.WATERMARK_KEY)
+
+    # Nobody is charged for TMDb being down, and the next run covers the same window
+    broken[stored[2]] = error
+    with app.app_context():
+        with pytest.raises(TMDbUnavailable):
+            sync.sync_changes(log=quiet)
+        assert stale_and_retried(stored)[1] == {stored[0]: 1}
+        assert sync.get_state(sync.WATERMARK_KEY) == watermark